@@ -5,20 +5,35 @@ from typing import Final
 import os
 import random
 import threading
+import time
 from datetime import datetime, timedelta
 import pytz
-from discord import Intents, Client, Message, DMChannel
-from huggingface_hub import InferenceClient
+import discord
+from discord import Intents, Client, AutoShardedClient, Message, DMChannel
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 import sympy
 from sympy import symbols, simplify, solve, diff, integrate, limit, latex
-from sympy.parsing.sympy_parser import parse_expr, standard_transformations, implicit_multiplication_application
+from sympy.parsing.sympy_parser import parse_expr, standard_transformations, implicit_multiplication_application, convert_xor
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from contextlib import aclosing, asynccontextmanager
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, fields
+from abc import ABC, abstractmethod
+from PIL import Image, ImageOps
 import pytesseract
 import io
+import json
+import sqlite3
+import signal
+import re
+import functools
+import math
+import hashlib
+import aiohttp
 
 PORT = int(os.environ.get("PORT", 10000))
 
@@ -42,31 +57,1032 @@ def run_server():
     print(f"HTTP server running on port {PORT}")
     server.serve_forever()
 
-threading.Thread(target=run_server, daemon=True).start()
-
-# Thread pool for running blocking operations
-executor = ThreadPoolExecutor(max_workers=3)
+# Workers fork from a fork server, so every fork - including a pool restart long after the HTTP/SQLite/aiohttp
+# threads exist - comes from a single-threaded process. Some Pythons ignore the '__main__' preload and each worker
+# re-runs this file, so the heavy libraries are preloaded too and that re-run only costs the module body itself
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    MP_CONTEXT = multiprocessing.get_context('forkserver')
+    MP_CONTEXT.set_forkserver_preload(['__main__', 'discord', 'aiohttp', 'sympy', 'PIL.Image', 'pytesseract',
+                                       'vaderSentiment.vaderSentiment', 'pytz'])
+else:
+    MP_CONTEXT = multiprocessing.get_context()
+
+class PoolBusy(Exception):
+    """Raised when a worker pool already has as many jobs queued as it accepts"""
+
+class ProcessWorkerPool:
+    """Process pool for CPU-heavy work with a bounded queue, timeouts and restart on worker death"""
+
+    def __init__(self, name: str, workers: int, max_pending: int, initializer=None, initargs=(), kill_on_timeout=False):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.initargs = initargs
+        self.kill_on_timeout = kill_on_timeout
+        self.pending = 0
+        self.pool = None
+
+    def start(self, wait: bool = True):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=MP_CONTEXT,
+                                            initializer=self.initializer, initargs=self.initargs)
+            # Start the workers now rather than on the first job; only startup waits for them, a restart
+            # runs on the event loop and lets them boot in the background
+            warm_up = self.pool.submit(int)
+            if wait:
+                warm_up.result()
+            print(f"[DEBUG] {self.name} pool started with {self.workers} workers")
+
+    def restart(self, kill: bool = False):
+        old_pool, self.pool = self.pool, None
+        if old_pool is not None:
+            if kill:
+                # shutdown() alone leaves a stuck worker spinning forever
+                for process in list((old_pool._processes or {}).values()):
+                    process.kill()
+            old_pool.shutdown(wait=False, cancel_futures=True)
+        self.start(wait=False)
+
+    @property
+    def busy(self) -> bool:
+        return self.pending >= self.max_pending
+
+    async def run(self, fn, *args, timeout: float):
+        if self.busy:
+            raise PoolBusy(f"{self.name} pool has {self.pending} jobs queued")
+
+        self.start(wait=False)
+        # Jobs caught up in a restart of this pool must not restart its healthy replacement
+        pool = self.pool
+        self.pending += 1
+        try:
+            loop = asyncio.get_event_loop()
+            return await asyncio.wait_for(loop.run_in_executor(pool, fn, *args), timeout=timeout)
+        except asyncio.TimeoutError:
+            if self.kill_on_timeout and self.pool is pool:
+                print(f"[ERROR] {self.name} job timed out after {timeout}s, killing workers")
+                self.restart(kill=True)
+            raise
+        except BrokenProcessPool:
+            if self.pool is pool:
+                print(f"[ERROR] {self.name} worker died, restarting pool")
+                self.restart()
+            raise
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # Still queued when a restart cancelled the pool's futures - same outcome as a dead worker
+            raise BrokenProcessPool(f"{self.name} pool restarted before the job ran")
+        finally:
+            self.pending -= 1
+
+# OCR gets its own processes so screenshots never hold up the event loop or AI calls
+# cpu_count() reports the host's CPUs, not the container's share - keep the default small
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', min(2, len(os.sched_getaffinity(0)))))
+OCR_MAX_PENDING = int(os.getenv('OCR_MAX_PENDING', OCR_WORKERS * 4))
+OCR_TIMEOUT = 60.0
+OCR_MAX_IMAGE_BYTES = int(os.getenv('OCR_MAX_IMAGE_BYTES', 10 * 1024 * 1024))
+OCR_MAX_IMAGES_PER_MESSAGE = int(os.getenv('OCR_MAX_IMAGES_PER_MESSAGE', 4))  # extra pages are skipped with a note
+OCR_MAX_DIMENSION = 2200  # longest side fed to tesseract - about 300 DPI for a letter-size page
+OCR_MIN_DIMENSION = 1000  # smaller crops get upscaled so text is tall enough to read
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+Image.MAX_IMAGE_PIXELS = 50_000_000  # refuse decompression bombs outright
+ocr_pool = ProcessWorkerPool("OCR", OCR_WORKERS, OCR_MAX_PENDING)
+
+# Math runs sandboxed too: sympy can spin forever or eat all memory on one nasty integral
+MATH_WORKERS = int(os.getenv('MATH_WORKERS', 2))
+MATH_MAX_PENDING = int(os.getenv('MATH_MAX_PENDING', MATH_WORKERS * 4))
+MATH_TIMEOUT = float(os.getenv('MATH_TIMEOUT', 5.0))  # seconds per problem, enforced inside the worker
+MATH_MEMORY_LIMIT_MB = int(os.getenv('MATH_MEMORY_LIMIT_MB', 512))  # extra address space each worker may grow by
+MATH_TOO_HARD = "[too hard to compute]"
+MATH_CACHE_SIZE = int(os.getenv('MATH_CACHE_SIZE', 1024))  # parses and results kept per worker, answers kept in the bot
+MATH_TRANSFORMATIONS = standard_transformations + (implicit_multiplication_application, convert_xor)
+MATH_LOCALS = {'e': sympy.E}  # students mean Euler's number, not a variable called e
+# Letter runs parse_expr may see - any other word would be split into a product of one-letter variables
+MATH_WORDS = frozenset({'sin', 'cos', 'tan', 'sec', 'csc', 'cot', 'asin', 'acos', 'atan', 'sinh', 'cosh', 'tanh',
+                        'exp', 'log', 'ln', 'sqrt', 'abs', 'pi', 'oo'})
+MATH_REPLY_MAX_TOKENS = int(os.getenv('MATH_REPLY_MAX_TOKENS', 150))  # the CAS already did the work, the model only explains
+MATH_RENDER = os.getenv('MATH_RENDER', 'true').lower() not in ('0', 'false', 'no')  # teaching replies get a PNG of the math (needs matplotlib)
+MATH_RENDER_DPI = 180
+MATH_RENDER_WAIT = 1.0  # seconds the reply waits for the image before going ahead without mentioning it
+MATH_RENDER_CACHE_SIZE = 256
+
+class MathTimeout(BaseException):
+    """Raised inside a math worker when a problem runs past MATH_TIMEOUT (BaseException so sympy's own except blocks can't eat it)"""
+
+def _raise_math_timeout(signum, frame):
+    raise MathTimeout()
+
+def init_math_worker(memory_limit_mb: int):
+    """Cap a math worker's memory and arm the per-problem alarm handler"""
+    signal.signal(signal.SIGALRM, _raise_math_timeout)
+    try:
+        import resource
+        # Limit on top of what the forked worker already maps, so the interpreter itself still fits
+        with open('/proc/self/statm') as f:
+            mapped = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+        limit = mapped + memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, OSError, ValueError) as e:
+        print(f"[ERROR] Could not limit math worker memory: {e}")
+
+math_pool = ProcessWorkerPool("Math", MATH_WORKERS, MATH_MAX_PENDING,
+                              initializer=init_math_worker, initargs=(MATH_MEMORY_LIMIT_MB,), kill_on_timeout=True)
+
+# OCR results are cached by exact image bytes (sha256) and language hint so reposted screenshots skip OCR
+OCR_CACHE_SIZE = 512
+OCR_CACHE_DIR = os.getenv('OCR_CACHE_DIR')  # set to also keep results on disk across restarts
+# Cheap English pass first; only escalate to the (much slower) multi-language models when it looks wrong
+OCR_ENGLISH_MIN_CONFIDENCE = 70  # mean word confidence (0-100) to accept the English-only pass
+OCR_ENGLISH_MIN_WORDS = 3
+OCR_FALLBACK_LANGS = 'eng+chi_sim+chi_tra'
+OCR_SCRIPT_LANGS = {
+    'Han': 'chi_sim+chi_tra+eng',
+    'Latin': 'eng+spa+fra',
+}
+OCR_SUBJECT_LANGS = {
+    'chinese': 'chi_sim+chi_tra+eng',
+    'spanish': 'spa+eng',
+    'french': 'fra+eng',
+}
 
 TOKEN: Final[str] = os.getenv('DISCORD_TOKEN')
 HF_API_KEY: Final[str] = os.getenv('HUGGINGFACE_API_KEY')
 
-hf_client = InferenceClient(
-    model="meta-llama/Llama-3.2-3B-Instruct",
-    token=HF_API_KEY
-)
+HF_MODEL: Final[str] = os.getenv('HF_MODEL', "meta-llama/Llama-3.2-3B-Instruct")
+# OpenAI-compatible chat completions endpoint - point this at stub_server.py for local testing
+HF_INFERENCE_URL: Final[str] = os.getenv('HF_INFERENCE_URL', "https://router.huggingface.co/v1/chat/completions")
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', 16))
+AI_SHARE_WINDOW = float(os.getenv('AI_SHARE_WINDOW', 0.05))  # seconds a finished answer is reused for identical prompts
+# Non-streaming calls run detached from the caller's wait_for, so they need their own deadline
+AI_REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=float(os.getenv('AI_REQUEST_TIMEOUT', 30)), sock_connect=10)
+
+class InferenceError(Exception):
+    """Non-200 response from the inference API (str() keeps the status code for rate limit checks)"""
+
+    def __init__(self, status: int, body: str, retry_after: float = None):
+        super().__init__(f"HTTP {status}: {body[:200]}")
+        self.status = status
+        self.retry_after = retry_after
+
+class InferenceBackend:
+    """Async chat completions over one pooled keep-alive aiohttp session"""
+
+    def __init__(self, url: str, model: str, token: str, max_concurrency: int):
+        self.url = url
+        self.model = model
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.session = None
+
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrency,
+            keepalive_timeout=60,
+            ttl_dns_cache=300
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"Authorization": f"Bearer {self.token}"},
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=10)
+        )
+        print(f"[DEBUG] Inference session ready ({self.url}, max {self.max_concurrency} concurrent)")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _payload(self, messages: list, max_tokens: int, stream: bool) -> dict:
+        return {
+            "model": self.model,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": max_tokens,
+            "top_p": 0.9,
+            "stream": stream
+        }
+
+    @staticmethod
+    async def _raise_for_status(resp):
+        if resp.status == 200:
+            return
+        body = await resp.text()
+        retry_after = resp.headers.get("Retry-After")
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        raise InferenceError(resp.status, body, retry_after)
+
+    async def chat(self, messages: list, max_tokens: int) -> str:
+        await self.start()
+        async with self.semaphore:
+            async with self.session.post(self.url, json=self._payload(messages, max_tokens, False), timeout=AI_REQUEST_TIMEOUT) as resp:
+                await self._raise_for_status(resp)
+                data = await resp.json()
+        return (data["choices"][0]["message"]["content"] or "").strip()
+
+    async def chat_stream(self, messages: list, max_tokens: int):
+        """Yield content deltas from a server-sent-events stream"""
+        await self.start()
+        async with self.semaphore:
+            async with self.session.post(self.url, json=self._payload(messages, max_tokens, True)) as resp:
+                await self._raise_for_status(resp)
+                async for raw_line in resp.content:
+                    line = raw_line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if not chunk.get("choices"):
+                        continue
+                    delta = chunk["choices"][0].get("delta", {}).get("content")
+                    if delta:
+                        yield delta
+
+class InferenceScheduler:
+    """Merges identical prompts into one upstream call; a finished answer is shared for `window` seconds more"""
+
+    def __init__(self, backend: InferenceBackend, window: float):
+        self.backend = backend
+        self.window = window
+        self.pending = {}  # prompt key -> future shared by every caller with that prompt
+        self.tasks = set()
+        self.stats = {"requests": 0, "coalesced": 0, "upstream": 0}
+
+    @staticmethod
+    def _key(messages: list, max_tokens: int) -> str:
+        raw = json.dumps([messages, max_tokens], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def complete(self, messages: list, max_tokens: int, charge=None) -> str:
+        """The reply for messages; charge() is awaited only if this caller's prompt actually goes upstream"""
+        self.stats["requests"] += 1
+        key = self._key(messages, max_tokens)
+
+        future = self.pending.get(key)
+        if future is not None:
+            # Same system prompt + same history in flight or just answered - just wait for it
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        # Nothing to merge with, so dispatch right away instead of holding the call for a window
+        future = asyncio.get_running_loop().create_future()
+        # Callers may time out and leave; don't warn about an exception nobody collected
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.pending[key] = future
+
+        task = asyncio.create_task(self._run(key, future, messages, max_tokens, charge))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        return await asyncio.shield(future)
+
+    async def _run(self, key: str, future: asyncio.Future, messages: list, max_tokens: int, charge=None):
+        try:
+            if charge is not None:
+                # A refusal (AIRateLimited) goes to every caller merged into this request
+                await charge()
+            self.stats["upstream"] += 1
+            future.set_result(await self.backend.chat(messages, max_tokens))
+        except Exception as e:
+            future.set_exception(e)
+            self._forget(key, future)
+        except asyncio.CancelledError:
+            future.cancel()
+            self._forget(key, future)
+            raise
+        else:
+            # Keep a good answer around briefly for duplicates that arrive just behind this one
+            asyncio.get_running_loop().call_later(self.window, self._forget, key, future)
+
+    def _forget(self, key: str, future: asyncio.Future):
+        if self.pending.get(key) is future:
+            del self.pending[key]
+
+class AIRateLimited(Exception):
+    """The limiter refused an AI call (str() starts with RATE_LIMIT like the old rate limit errors)"""
+
+    def __init__(self, reason: str, retry_in: float):
+        super().__init__(f"RATE_LIMIT ({reason}, retry in {retry_in:.0f}s)")
+        self.reason = reason
+        self.retry_in = retry_in
+
+class TokenBucket:
+    """Refills continuously at rate tokens/second up to capacity"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def available(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self, now: float, needed: float = 1.0) -> float:
+        """Seconds until at least `needed` tokens are in the bucket"""
+        return max(0.0, (needed - self.available(now)) / self.rate)
+
+class AIRateLimiter:
+    """Token buckets per user, per guild and for the upstream quota, plus Retry-After aware backoff after a 429"""
+
+    def __init__(self):
+        self.users = OrderedDict()
+        self.guilds = OrderedDict()
+        self.upstream = TokenBucket(AI_UPSTREAM_PER_MINUTE / 60, AI_UPSTREAM_BURST)
+        self.blocked_until = 0.0  # monotonic time upstream told us to back off until
+        self.backoff = AI_BACKOFF_INITIAL
+        self.notified = {}  # user id -> when they were last told about a limit
+        self.tasks = set()
+        self.stats = {"allowed": 0, "user": 0, "guild": 0, "upstream": 0, "backoff": 0, "rate_limited": 0}
+
+    @staticmethod
+    def _bucket(buckets: OrderedDict, key: int, per_minute: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(per_minute / 60, burst)
+            if len(buckets) > AI_LIMITER_MAX_BUCKETS:
+                buckets.popitem(last=False)
+        buckets.move_to_end(key)
+        return bucket
+
+    @property
+    def blocked(self) -> bool:
+        return time.monotonic() < self.blocked_until
+
+    async def _take_upstream(self, needed: float) -> float:
+        """Spend an upstream token - from the bucket every process shares when there is one - 0 or seconds to wait"""
+        if state_backend.shared:
+            try:
+                wait = await state_backend.take_token("ai_upstream", self.upstream.rate, self.upstream.capacity, needed)
+                if wait is not None:
+                    return wait
+            except Exception as e:
+                print(f"[ERROR] Shared AI bucket unavailable, using this process's own: {e}")
+
+        now = time.monotonic()
+        if self.upstream.available(now) < needed:
+            return self.upstream.wait_time(now, needed)
+        self.upstream.tokens -= 1
+        return 0
+
+    def _background(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"[ERROR] Sharing AI limit state failed: {task.exception()}")
+
+    async def check(self, user_id: int) -> tuple:
+        """(None, 0) and spend a token from the user's bucket if they may ask, else (reason, seconds to wait)"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self._deny("backoff", self.blocked_until - now)
+
+        user = self._bucket(self.users, user_id, AI_USER_PER_MINUTE, AI_USER_BURST)
+        if user.available(now) < 1:
+            return self._deny("user", user.wait_time(now))
+        user.tokens -= 1
+        return (None, 0)
+
+    async def take(self, guild_id: int = None, teaching: bool = False):
+        """Spend the guild and upstream tokens for a request that is really being sent, else raise AIRateLimited"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            raise AIRateLimited(*self._deny("backoff", self.blocked_until - now))
+
+        # A guild lives on one shard, so its bucket can stay in this process
+        guild = self._bucket(self.guilds, guild_id, AI_GUILD_PER_MINUTE, AI_GUILD_BURST) if guild_id else None
+        if guild and guild.available(now) < 1:
+            raise AIRateLimited(*self._deny("guild", guild.wait_time(now)))
+
+        # Priority lane: the last slice of the upstream bucket is kept for teaching requests
+        needed = 1 if teaching else 1 + self.upstream.capacity * AI_TEACHING_RESERVE
+        wait = await self._take_upstream(needed)
+        if wait:
+            raise AIRateLimited(*self._deny("upstream", wait))
+
+        if guild:
+            guild.tokens -= 1
+        self.stats["allowed"] += 1
+
+    def _deny(self, reason: str, retry_in: float) -> tuple:
+        self.stats[reason] += 1
+        print(f"[DEBUG] AI call limited by {reason} bucket, retry in {retry_in:.0f}s ({self.stats})")
+        return (reason, retry_in)
+
+    async def allow_background(self) -> bool:
+        """Background work (canned reply refills) only runs while upstream has plenty of headroom"""
+        if self.blocked:
+            return False
+        return not await self._take_upstream(1 + self.upstream.capacity * AI_TEACHING_RESERVE * 2)
+
+    def record_rate_limit(self, retry_after: float = None):
+        """Upstream said 429 - pause for Retry-After if given, otherwise an exponential backoff"""
+        delay = min(retry_after if retry_after else self.backoff, AI_BACKOFF_MAX)
+        self.backoff = min(self.backoff * 2, AI_BACKOFF_MAX)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        self.upstream.tokens = 0
+        self.upstream.updated = time.monotonic()  # refill from now, not from whenever the bucket was last read
+        self.stats["rate_limited"] += 1
+        print(f"[ERROR] Upstream rate limited, backing off {delay:.0f}s")
+        if state_backend.shared:
+            # Wall-clock deadline so other processes can convert it to their own monotonic clock
+            self._background(state_backend.set_flag("ai_blocked_until", str(time.time() + delay), timedelta(seconds=delay)))
+            self._background(state_backend.take_token("ai_upstream", self.upstream.rate, self.upstream.capacity, drain=True))
+
+    def record_success(self):
+        if self.backoff != AI_BACKOFF_INITIAL:
+            print(f"[DEBUG] Upstream recovered, resetting backoff")
+            self.backoff = AI_BACKOFF_INITIAL
+
+    def should_notify(self, user_id: int, reason: str) -> bool:
+        """Always explain upstream waits; "slow down" goes to each user at most once per AI_LIMIT_NOTIFY_INTERVAL"""
+        if reason != "user":
+            return True
+        now = time.monotonic()
+        if now - self.notified.get(user_id, -AI_LIMIT_NOTIFY_INTERVAL) < AI_LIMIT_NOTIFY_INTERVAL:
+            return False
+        self.notified[user_id] = now
+        if len(self.notified) > AI_LIMITER_MAX_BUCKETS:
+            self.notified.pop(next(iter(self.notified)))
+        return True
+
+inference = InferenceBackend(HF_INFERENCE_URL, HF_MODEL, HF_API_KEY, AI_MAX_CONCURRENCY)
+inference_scheduler = InferenceScheduler(inference, AI_SHARE_WINDOW)
+
 sentiment_analyzer = SentimentIntensityAnalyzer()
 
+# Sharding: set SHARD_COUNT (total across all processes) and SHARD_IDS for the shards this
+# process runs, e.g. SHARD_IDS=0-3 or SHARD_IDS=4,5,6,7. SHARD_COUNT=auto lets Discord pick.
+SHARD_COUNT = os.getenv('SHARD_COUNT')
+SHARD_IDS = os.getenv('SHARD_IDS')
+
+def parse_shard_ids(spec: str) -> list:
+    shard_ids = []
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-')
+            shard_ids.extend(range(int(first), int(last) + 1))
+        elif part:
+            shard_ids.append(int(part))
+    return shard_ids
+
 intents: Intents = Intents.default()
 intents.message_content = True
-client: Client = Client(intents=intents)
-
-conversation_active = {}
-ai_limit_reached = False
-ai_limit_notified = False
-user_memory = {}
-welcomed_users = set()
-user_modes = {}
+
+if SHARD_COUNT or SHARD_IDS:
+    shard_count = None if not SHARD_COUNT or SHARD_COUNT == 'auto' else int(SHARD_COUNT)
+    shard_ids = parse_shard_ids(SHARD_IDS) if SHARD_IDS else None
+    if shard_ids and shard_count is None:
+        raise ValueError("SHARD_IDS needs an explicit SHARD_COUNT")
+    client: Client = AutoShardedClient(intents=intents, shard_count=shard_count, shard_ids=shard_ids)
+    print(f"Sharding enabled: shard_count={shard_count or 'auto'}, shard_ids={shard_ids or 'all'}")
+else:
+    client: Client = Client(intents=intents)
+
+# AI rate limits - spikes get slowed down per user/guild instead of taking the AI offline for everyone
+AI_USER_PER_MINUTE = float(os.getenv('AI_USER_PER_MINUTE', 6))
+AI_USER_BURST = 4
+AI_GUILD_PER_MINUTE = float(os.getenv('AI_GUILD_PER_MINUTE', 30))
+AI_GUILD_BURST = 15
+AI_UPSTREAM_PER_MINUTE = float(os.getenv('AI_UPSTREAM_PER_MINUTE', 60))  # keep inside the provider's quota
+AI_UPSTREAM_BURST = 20
+AI_TEACHING_RESERVE = 0.25  # share of the upstream bucket only teaching requests may spend
+AI_BACKOFF_INITIAL = 30.0  # seconds to pause after a 429 without Retry-After, doubling up to AI_BACKOFF_MAX
+AI_BACKOFF_MAX = 900.0
+AI_LIMIT_NOTIFY_INTERVAL = 300.0
+AI_LIMITER_MAX_BUCKETS = 10000
+ai_limiter = AIRateLimiter()
 MODE_TIMEOUT = timedelta(minutes=30)
+EASTERN = pytz.timezone('US/Eastern')
+
+# Session store limits - idle sessions are reset after MODE_TIMEOUT and dropped from memory after SESSION_RETENTION
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', 5000))
+SESSION_RETENTION = timedelta(days=7)
+SESSION_SWEEP_INTERVAL = 60  # seconds
+
+# Persistent state - sessions survive restarts (STATE_BACKEND=memory turns it off)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')  # sqlite | redis (shared between processes) | memory
+# Must live on a persistent disk in production - the app directory is rebuilt on every Render deploy (see render.yaml)
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'abg_state.db')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 5))  # seconds between write-behind batches
+STATE_RETENTION = timedelta(days=90)  # stored sessions untouched this long are deleted
+
+@dataclass(slots=True)
+class UserSession:
+    """Everything we keep about one user: mode, conversation, history and memory"""
+    mode: str = "bestie"
+    last_activity: datetime = field(default_factory=datetime.now)
+    session_active: bool = False
+    teaching_mode: bool = False
+    conversation_active: bool = False
+    history: list = field(default_factory=list)
+    history_summary: str = None
+    last_tone: str = None
+    memory: dict = None
+    welcomed: bool = False
+
+    def end_conversation(self):
+        self.conversation_active = False
+        self.teaching_mode = False
+        self.history = []
+        self.history_summary = None
+        self.last_tone = None
+
+    def expire(self):
+        """Back to defaults after MODE_TIMEOUT of silence (welcome status and memory are kept)"""
+        self.end_conversation()
+        self.mode = "bestie"
+        self.session_active = False
+
+    def to_record(self) -> dict:
+        return {
+            "mode": self.mode,
+            "last_activity": self.last_activity.isoformat(),
+            "session_active": self.session_active,
+            "teaching_mode": self.teaching_mode,
+            "conversation_active": self.conversation_active,
+            "history": self.history,
+            "history_summary": self.history_summary,
+            "last_tone": self.last_tone,
+            "memory": self.memory,
+            "welcomed": self.welcomed
+        }
+
+    @classmethod
+    def from_record(cls, record: dict) -> "UserSession":
+        # Records written by an older/newer version may carry fields this one doesn't have
+        known = {f.name for f in fields(cls)}
+        record = {key: value for key, value in record.items() if key in known}
+        if "last_activity" in record:
+            record["last_activity"] = datetime.fromisoformat(record["last_activity"])
+        return cls(**record)
+
+class StateBackend(ABC):
+    """Storage for session records between restarts.
+
+    SQLite is built in; a Redis (or any other) backend just implements these coroutines.
+    Records are the plain dicts from UserSession.to_record(). A shared backend is one several
+    bot processes use at once - the store then re-reads a user's record on every message and
+    writes changes straight through instead of batching them.
+    """
+
+    shared = False
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def load(self, user_id: int):
+        """Return the stored record for user_id, or None"""
+
+    @abstractmethod
+    async def save_many(self, records: dict):
+        """Upsert {user_id: record} in one batch"""
+
+    @abstractmethod
+    async def active_user_ids(self, since: datetime) -> list:
+        """Users with a conversation still open and activity after since"""
+
+    @abstractmethod
+    async def prune(self, before: datetime) -> int:
+        """Delete records not touched since before"""
+
+    async def get_flag(self, name: str):
+        """Bot-wide flags (e.g. the AI limit) - only shared backends need to store them"""
+        return None
+
+    async def set_flag(self, name: str, value: str, ttl: timedelta):
+        pass
+
+    async def take_token(self, name: str, rate: float, capacity: float, needed: float = 1, drain: bool = False):
+        """Bot-wide token bucket: spend one token if at least `needed` are there and return 0, else the seconds
+        to wait. drain empties it. None means the backend doesn't share buckets and the caller keeps its own"""
+        return None
+
+class MemoryStateBackend(StateBackend):
+    """No persistence - sessions only live in the SessionStore"""
+
+    async def load(self, user_id: int):
+        return None
+
+    async def save_many(self, records: dict):
+        pass
+
+    async def active_user_ids(self, since: datetime) -> list:
+        return []
+
+    async def prune(self, before: datetime) -> int:
+        return 0
+
+class SQLiteStateBackend(StateBackend):
+    """SQLite in WAL mode, driven from one dedicated thread so the event loop never touches the disk"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-db")
+        self.conn = None
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.db_executor, fn, *args)
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            conversation_active INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )""")
+        self.conn.commit()
+
+    def _load(self, user_id: int):
+        row = self.conn.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save_many(self, rows: list):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, data, conversation_active, updated_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+
+    def _active_user_ids(self, since: float) -> list:
+        rows = self.conn.execute(
+            "SELECT user_id FROM sessions WHERE conversation_active = 1 AND updated_at > ?", (since,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def _prune(self, before: float) -> int:
+        with self.conn:
+            return self.conn.execute("DELETE FROM sessions WHERE updated_at < ?", (before,)).rowcount
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def open(self):
+        await self._run(self._open)
+        print(f"[DEBUG] State database ready at {self.path}")
+
+    async def close(self):
+        await self._run(self._close)
+        self.db_executor.shutdown(wait=True)
+
+    async def load(self, user_id: int):
+        return await self._run(self._load, user_id)
+
+    async def save_many(self, records: dict):
+        # Serialize on the loop (records are live session data), write in the db thread
+        rows = [
+            (user_id, json.dumps(record, ensure_ascii=False), int(record["conversation_active"]),
+             datetime.fromisoformat(record["last_activity"]).timestamp())
+            for user_id, record in records.items()
+        ]
+        await self._run(self._save_many, rows)
+
+    async def active_user_ids(self, since: datetime) -> list:
+        return await self._run(self._active_user_ids, since.timestamp())
+
+    async def prune(self, before: datetime) -> int:
+        return await self._run(self._prune, before.timestamp())
+
+# Refill, check and spend in one atomic step, on the Redis server's clock so every process agrees
+REDIS_TOKEN_BUCKET_SCRIPT = """
+local rate, capacity, needed, drain = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), ARGV[4] == '1'
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if drain then
+    tokens = 0
+elseif tokens >= needed then
+    tokens = tokens - 1
+else
+    wait = (needed - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+class RedisStateBackend(StateBackend):
+    """Redis (or any Redis-protocol server) shared by every bot process/shard"""
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "abg:"):
+        self.url = url
+        self.prefix = prefix
+        self.redis = None
+        self.take_token_script = None
+
+    async def open(self):
+        # Optional dependency - only needed when STATE_BACKEND=redis
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(self.url, decode_responses=True)
+        await self.redis.ping()
+        print(f"[DEBUG] Redis state backend ready")
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+
+    async def load(self, user_id: int):
+        data = await self.redis.get(f"{self.prefix}session:{user_id}")
+        return json.loads(data) if data else None
+
+    async def save_many(self, records: dict):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, record in records.items():
+                pipe.set(f"{self.prefix}session:{user_id}", json.dumps(record, ensure_ascii=False), ex=STATE_RETENTION)
+                # Open conversations by last activity, so a restarted shard knows whose unaddressed messages to load
+                if record.get("conversation_active"):
+                    pipe.zadd(f"{self.prefix}active", {str(user_id): datetime.fromisoformat(record["last_activity"]).timestamp()})
+                else:
+                    pipe.zrem(f"{self.prefix}active", str(user_id))
+            await pipe.execute()
+
+    async def active_user_ids(self, since: datetime) -> list:
+        return [int(user_id) for user_id in await self.redis.zrangebyscore(f"{self.prefix}active", since.timestamp(), "+inf")]
+
+    async def prune(self, before: datetime) -> int:
+        # Session keys expire on their own; only the active index needs trimming
+        return await self.redis.zremrangebyscore(f"{self.prefix}active", "-inf", before.timestamp())
+
+    async def get_flag(self, name: str):
+        return await self.redis.get(f"{self.prefix}flag:{name}")
+
+    async def set_flag(self, name: str, value: str, ttl: timedelta):
+        await self.redis.set(f"{self.prefix}flag:{name}", value, ex=ttl)
+
+    async def take_token(self, name: str, rate: float, capacity: float, needed: float = 1, drain: bool = False):
+        if self.take_token_script is None:
+            self.take_token_script = self.redis.register_script(REDIS_TOKEN_BUCKET_SCRIPT)
+        wait = await self.take_token_script(keys=[f"{self.prefix}bucket:{name}"], args=[rate, capacity, needed, int(drain)])
+        return float(wait)
+
+class SessionStore:
+    """Per-user sessions with an LRU cap, a background sweeper and write-behind persistence"""
+
+    def __init__(self, backend: StateBackend, max_sessions: int, idle_timeout: timedelta, retention: timedelta):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.retention = retention
+        self.sessions = OrderedDict()
+        self.dirty = set()
+        self.unsaved = {}  # records of dirty sessions pushed out of memory before their flush
+        self.resumable = set()  # users with an open conversation in storage but not loaded yet
+        self.tasks = []
+        self.flush_task = None
+        self.evictions = 0
+        self.expirations = 0
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.sessions
+
+    def get(self, user_id: int):
+        """Look a session up without creating it (most guild messages never talk to the bot)"""
+        return self.sessions.get(user_id)
+
+    def get_or_create(self, user_id: int) -> UserSession:
+        """Fetch a session for changing it - it gets written back on the next flush"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = UserSession()
+            self._insert(user_id, session)
+        else:
+            self.sessions.move_to_end(user_id)
+        self.mark_dirty(user_id)
+        return session
+
+    def mark_dirty(self, user_id: int):
+        if user_id not in self.sessions:
+            return
+        self.dirty.add(user_id)
+
+        # Other processes read this user's record on their next message, so write it right away
+        if self.backend.shared and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.get_event_loop().create_task(self.flush())
+
+    def _insert(self, user_id: int, session: UserSession):
+        self.sessions[user_id] = session
+        self.resumable.discard(user_id)
+        while len(self.sessions) > self.max_sessions:
+            self._drop(*self.sessions.popitem(last=False))
+            self.evictions += 1
+
+    def _drop(self, user_id: int, session: UserSession):
+        if user_id in self.dirty:
+            self.dirty.discard(user_id)
+            self.unsaved[user_id] = session.to_record()
+
+    async def ensure_loaded(self, user_id: int, addressed: bool):
+        """Pull a user's stored session into memory on their first message after a restart.
+
+        With a shared backend the record is re-read on every message to the bot, since the user's
+        last message may have been handled by another shard.
+        """
+        if not (addressed or user_id in self.resumable):
+            return
+        if self.backend.shared:
+            if user_id in user_mailboxes and user_id in self.sessions:
+                # A reply is still being written into this session - reloading would orphan it
+                return
+            if user_id not in self.dirty and user_id not in self.unsaved:
+                self.sessions.pop(user_id, None)
+        elif user_id in self.sessions:
+            return
+
+        record = self.unsaved.get(user_id)
+        if record is None:
+            try:
+                record = await self.backend.load(user_id)
+            except Exception as e:
+                print(f"[ERROR] Loading session for {user_id} failed: {e}")
+                return
+
+        # Another message from the same user may have created the session while we were waiting
+        if record is not None and user_id not in self.sessions:
+            try:
+                session = UserSession.from_record(record)
+            except (TypeError, ValueError) as e:
+                print(f"[ERROR] Stored session for {user_id} is unreadable, starting fresh: {e}")
+                session = UserSession()
+            self._insert(user_id, session)
+        self.resumable.discard(user_id)
+
+    async def flush(self):
+        records = self.unsaved
+        self.unsaved = {}
+        for user_id in self.dirty:
+            session = self.sessions.get(user_id)
+            if session is not None:
+                records[user_id] = session.to_record()
+        self.dirty = set()
+
+        if not records:
+            return
+        try:
+            await self.backend.save_many(records)
+        except Exception as e:
+            print(f"[ERROR] Saving {len(records)} sessions failed, will retry: {e}")
+            # Keep whatever newer state came in meanwhile
+            records.update(self.unsaved)
+            self.unsaved = records
+
+    def sweep(self) -> int:
+        """Reset sessions idle past the timeout and drop ones idle past retention from memory"""
+        now = datetime.now()
+        expired = 0
+
+        for user_id, session in list(self.sessions.items()):
+            idle = now - session.last_activity
+            if idle > self.retention:
+                del self.sessions[user_id]
+                self._drop(user_id, session)
+                expired += 1
+            elif idle > self.idle_timeout and (session.conversation_active or session.history or session.session_active):
+                session.expire()
+                self.dirty.add(user_id)
+                expired += 1
+
+        self.expirations += expired
+        return expired
+
+    def stats(self) -> dict:
+        history_messages = 0
+        approx_bytes = 0
+        for session in self.sessions.values():
+            history_messages += len(session.history)
+            approx_bytes += sys.getsizeof(session) + sys.getsizeof(session.history)
+            approx_bytes += sum(sys.getsizeof(turn["content"]) for turn in session.history)
+            if session.history_summary:
+                approx_bytes += sys.getsizeof(session.history_summary)
+
+        try:
+            with open('/proc/self/statm') as f:
+                rss_mb = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+        except (OSError, ValueError):
+            rss_mb = None
+
+        return {
+            "sessions": len(self.sessions),
+            "active_conversations": sum(1 for session in self.sessions.values() if session.conversation_active),
+            "history_messages": history_messages,
+            "approx_kb": approx_bytes // 1024,
+            "rss_mb": round(rss_mb, 1) if rss_mb else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "dirty": len(self.dirty) + len(self.unsaved)
+        }
+
+    async def run_sweeper(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                expired = self.sweep()
+                pruned = await self.backend.prune(datetime.now() - STATE_RETENTION)
+                print(f"[DEBUG] Session sweep: {expired} expired, {pruned} pruned from storage, {self.stats()}")
+            except Exception as e:
+                print(f"[ERROR] Session sweep failed: {e}")
+
+    async def run_flusher(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    async def open(self):
+        """Connect storage, remember who had a conversation open, and start the background tasks"""
+        await self.backend.open()
+        self.resumable = set(await self.backend.active_user_ids(datetime.now() - self.idle_timeout))
+        print(f"[DEBUG] {len(self.resumable)} conversations can resume from storage")
+
+        self.tasks = [
+            asyncio.create_task(self.run_sweeper(SESSION_SWEEP_INTERVAL)),
+            asyncio.create_task(self.run_flusher(STATE_FLUSH_INTERVAL))
+        ]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await self.flush()
+        await self.backend.close()
+
+if STATE_BACKEND == 'redis':
+    state_backend = RedisStateBackend(REDIS_URL)
+elif STATE_BACKEND == 'sqlite':
+    state_backend = SQLiteStateBackend(STATE_DB_PATH)
+else:
+    state_backend = MemoryStateBackend()
+sessions = SessionStore(state_backend, MAX_SESSIONS, MODE_TIMEOUT, SESSION_RETENTION)
+
+class UserMailbox:
+    """Messages from one user waiting for their AI turn"""
+    __slots__ = ('lock', 'pending', 'holders')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = []  # (message, text) not yet picked up by a turn
+        self.holders = 0  # handlers currently using this mailbox
+
+user_mailboxes = {}
+
+@asynccontextmanager
+async def user_turn(user_id: int, message: Message = None, text: str = None):
+    """Run one AI turn per user at a time; yields every message that queued up meanwhile (empty if an earlier turn took ours).
+
+    Commands pass no text - they just wait their turn and leave queued chat messages to their own handlers.
+    """
+    mailbox = user_mailboxes.get(user_id)
+    if mailbox is None:
+        mailbox = user_mailboxes[user_id] = UserMailbox()
+    if text is not None:
+        mailbox.pending.append((message, text))
+    mailbox.holders += 1
+    try:
+        async with mailbox.lock:
+            if text is None:
+                batch = []
+            else:
+                batch, mailbox.pending = mailbox.pending, []
+            if len(batch) > 1:
+                print(f"[DEBUG] Merging {len(batch)} queued messages from user {user_id} into one turn")
+            yield batch
+    finally:
+        mailbox.holders -= 1
+        if not mailbox.holders:
+            del user_mailboxes[user_id]
 
 NEW_USER_WELCOME = """hey! welcome 💕 i'm abg tutor, here to help you with APs, SAT, and ACT!
 
@@ -100,10 +1116,13 @@ GOODBYE_MESSAGES_FLIRTY = [
     "leaving me already? 😭 hmu soon ok sweetie? 💕"
 ]
 
-user_histories = {}
-MAX_HISTORY_CASUAL = 10
-MAX_HISTORY_TEACHING = 25
-user_last_tone = {}
+# History is trimmed to a token budget (system prompt included) instead of a fixed message count
+PROMPT_TOKEN_BUDGET_CASUAL = int(os.getenv('PROMPT_TOKEN_BUDGET_CASUAL', 1500))
+PROMPT_TOKEN_BUDGET_TEACHING = int(os.getenv('PROMPT_TOKEN_BUDGET_TEACHING', 3000))
+HISTORY_SUMMARIES = os.getenv('HISTORY_SUMMARIES', 'true').lower() != 'false'
+HISTORY_SUMMARY_TOKENS = 150  # cap for the running summary of trimmed turns
+MESSAGE_TOKEN_OVERHEAD = 4  # role/header tokens the chat template adds per message
+TOKENIZER_PATH = os.getenv('TOKENIZER_PATH')  # optional local tokenizer.json for exact counts
 
 NICKNAMES_BESTIE = ["bestie", "bro", "dude", "friend", "homie", "sis"]
 NICKNAMES_FLIRTY = ["cutie", "babe", "smartie", "love", "hon", "sweetheart"]
@@ -115,6 +1134,28 @@ EMOJIS_TEACHING = ["📚", "✨", "💡", "🎯", "💪", "🔥", "⭐", "👍",
 EMOJIS_FLIRTY = ["💕", "😘", "💖", "😏", "✨", "💗", "😍", "🥰", "💋", "😉", "😈", "🥵", "🫦", "👀"]
 EMOJI_PROBABILITY = 0.5
 
+# Streaming replies: post as soon as tokens arrive, then edit the message as more come in
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'true').lower() != 'false'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.2))  # seconds between edits
+STREAM_FIRST_CHUNK_CHARS = 12  # don't post a lonely "hey" and then rewrite it
+AI_FIRST_TOKEN_TIMEOUT = 20.0
+AI_STREAM_TIMEOUT = 60.0
+
+# Image progress: one status message that follows the real pipeline, within a per-channel edit budget
+PROGRESS_DELAY = 0.7  # cached/fast results finish before this and never show a status at all
+PROGRESS_EDIT_BUDGET = 3  # status edits allowed per channel per window, across all users
+PROGRESS_EDIT_WINDOW = 10.0
+PROGRESS_STAGES = {
+    'download': "grabbing your pic",
+    'ocr': "reading it",
+    'thinking': "thinking about it",
+}
+
+# Canned replies for synthetic prompts like "user just selected bestie mode"
+CANNED_CACHE_SIZE = 64
+CANNED_POOL_SIZE = 4  # variants kept per (mode, teaching_mode, subject, context, time of day)
+CANNED_TTL = timedelta(minutes=30)
+
 """
 MESSAGE FLOW ARCHITECTURE:
 
@@ -210,200 +1251,843 @@ def get_gibberish_response(mode: str) -> str:
 
     return random.choice(responses_flirty if mode == "flirty" else responses_bestie)
 
-async def process_image(attachment_url: str) -> str:
-    """Extract text from image using OCR"""
+OCR_BUSY_MESSAGE = "[OCR busy]"
+OCR_TOO_BIG_MESSAGE = "[Image uploaded but it's too big to read - please send a smaller screenshot or crop it]"
+
+class OCRCache:
+    """LRU cache of OCR descriptions keyed on image sha256 plus the OCR language hint.
+
+    Only byte-identical images match - same-layout worksheets and screenshots hash alike perceptually,
+    and a near match would hand one user's text to somebody else.
+    """
+
+    def __init__(self, max_entries: int, cache_dir: str = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()  # sha256 -> description
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def _read_disk(self, digest: str):
+        try:
+            with open(self._disk_path(digest), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, digest: str, description: str):
+        try:
+            with open(self._disk_path(digest), 'w', encoding='utf-8') as f:
+                json.dump({"description": description}, f, ensure_ascii=False)
+        except OSError as e:
+            print(f"[ERROR] Couldn't write OCR cache file: {e}")
+
+    def _remember(self, digest: str, description: str):
+        self.entries[digest] = description
+        self.entries.move_to_end(digest)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get(self, digest: str):
+        description = self.entries.get(digest)
+        if description is None and self.cache_dir:
+            record = await asyncio.to_thread(self._read_disk, digest)
+            if record:
+                description = record["description"]
+                self._remember(digest, description)
+
+        if description is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(digest)
+        self.hits += 1
+        return description
+
+    async def put(self, digest: str, description: str):
+        self._remember(digest, description)
+        if self.cache_dir:
+            await asyncio.to_thread(self._write_disk, digest, description)
+
+ocr_cache = OCRCache(OCR_CACHE_SIZE, OCR_CACHE_DIR)
+
+def choose_ocr_langs(image) -> str:
+    """Pick the tesseract models to escalate to after a weak English pass - runs in an OCR worker"""
     try:
-        import aiohttp
-        from PIL import ImageEnhance
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(attachment_url) as resp:
-                if resp.status == 200:
-                    image_data = await resp.read()
-                    image = Image.open(io.BytesIO(image_data))
-
-                    # Convert to RGB if necessary
-                    if image.mode != 'RGB':
-                        image = image.convert('RGB')
-
-                    # Preprocess image to improve OCR accuracy
-                    # Increase contrast
-                    enhancer = ImageEnhance.Contrast(image)
-                    image = enhancer.enhance(2.0)
-
-                    # Increase sharpness
-                    enhancer = ImageEnhance.Sharpness(image)
-                    image = enhancer.enhance(2.0)
-
-                    # Try multiple language combinations
-                    loop = asyncio.get_event_loop()
-
-                    # First try: English + Simplified Chinese + Traditional Chinese
-                    text = await loop.run_in_executor(
-                        executor,
-                        lambda: pytesseract.image_to_string(image, lang='eng+chi_sim+chi_tra')
-                    )
+        script = pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT).get('script')
+    except Exception:
+        # OSD needs a decent amount of text; no verdict means we fall back to the old combination
+        script = None
+
+    if script in OCR_SCRIPT_LANGS:
+        return OCR_SCRIPT_LANGS[script]
+    return OCR_FALLBACK_LANGS
+
+def otsu_threshold(histogram: list) -> int:
+    """Grey level that best separates ink from paper (Otsu's method)"""
+    total = sum(histogram)
+    sum_all = sum(level * count for level, count in enumerate(histogram))
+    sum_background = 0
+    weight_background = 0
+    best_variance = 0
+    threshold = 127
+
+    for level, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+
+        sum_background += level * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_variance = variance
+            threshold = level
+
+    return threshold
+
+def prepare_ocr_image(image_data: bytes):
+    """Decode straight to grayscale at OCR size, then binarize - runs in an OCR worker"""
+    image = Image.open(io.BytesIO(image_data))
+
+    # JPEG phone photos can decode at a fraction of full size for free
+    image.draft('L', (OCR_MAX_DIMENSION, OCR_MAX_DIMENSION))
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('L')
+
+    longest_side = max(image.size)
+    if longest_side > OCR_MAX_DIMENSION:
+        image.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.Resampling.LANCZOS)
+    elif longest_side < OCR_MIN_DIMENSION:
+        scale = OCR_MIN_DIMENSION / longest_side
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.Resampling.LANCZOS)
+
+    image = ImageOps.autocontrast(image, cutoff=1)
+    threshold = otsu_threshold(image.histogram())
+    image = image.point([0] * (threshold + 1) + [255] * (255 - threshold))
+
+    # Dark mode screenshots: tesseract wants dark text on a light background
+    if image.histogram()[0] > image.width * image.height / 2:
+        image = ImageOps.invert(image)
+
+    return image
+
+def ocr_image_bytes(image_data: bytes, lang_hint: str = None) -> tuple:
+    """Decode, downscale, binarize and OCR an image - runs in an OCR worker process.
+
+    Without a hint, an English-only pass runs first and is kept if tesseract is confident in it;
+    otherwise script detection picks which language models to rerun with.
+    Returns (text, timings) with per-stage timings in milliseconds.
+    """
+    timings = {}
+    started = time.perf_counter()
+    image = prepare_ocr_image(image_data)
+    timings["preprocess"] = (time.perf_counter() - started) * 1000
+
+    if lang_hint:
+        started = time.perf_counter()
+        text = pytesseract.image_to_string(image, lang=lang_hint)
+        timings[f"ocr[{lang_hint}]"] = (time.perf_counter() - started) * 1000
+        return (text, timings)
+
+    started = time.perf_counter()
+    data = pytesseract.image_to_data(image, lang='eng', output_type=pytesseract.Output.DICT)
+    words = [(word, float(conf)) for word, conf in zip(data['text'], data['conf']) if word.strip() and float(conf) >= 0]
+    confidence = sum(conf for _, conf in words) / len(words) if words else 0.0
+    english_text = ' '.join(word for word, _ in words)
+    timings["ocr[eng]"] = (time.perf_counter() - started) * 1000
+
+    if len(words) >= OCR_ENGLISH_MIN_WORDS and confidence >= OCR_ENGLISH_MIN_CONFIDENCE:
+        return (english_text, timings)
+
+    started = time.perf_counter()
+    langs = choose_ocr_langs(image)
+    text = pytesseract.image_to_string(image, lang=langs)
+    timings[f"ocr[{langs}]"] = (time.perf_counter() - started) * 1000
+
+    # A blank escalation shouldn't throw away what English found
+    return (text if text.strip() else english_text, timings)
+
+def get_ocr_busy_response(mode: str) -> str:
+    """Reply when the OCR queue is full - tell them to resend instead of waiting forever"""
+    if mode == "flirty":
+        return "omg babe so many pics coming in rn 😭 send it again in a sec?"
+    return "bestie i'm drowning in screenshots rn 😭 send it again in a sec?"
+
+_http_session = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """One keep-alive session for attachment downloads"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30, sock_connect=10))
+    return _http_session
+
+DOWNLOAD_TOO_LARGE = object()  # download_attachment result for files past the size cap
+
+async def download_attachment(url: str, max_bytes: int):
+    """Stream an attachment into memory; None if it can't be fetched, DOWNLOAD_TOO_LARGE once it passes max_bytes"""
+    async with get_http_session().get(url) as resp:
+        if resp.status != 200:
+            return None
+        if resp.content_length and resp.content_length > max_bytes:
+            resp.close()
+            return DOWNLOAD_TOO_LARGE
+
+        data = bytearray()
+        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            data.extend(chunk)
+            if len(data) > max_bytes:
+                if resp.connection is None:
+                    # Body already fully buffered and the connection released - drain it so the pool stays clean
+                    await resp.read()
+                else:
+                    # Drop the connection instead of handing a half-read one back to the pool
+                    resp.close()
+                return DOWNLOAD_TOO_LARGE
+        return bytes(data)
+
+async def process_image(attachment_url: str, subject: str = 'general', size: int = None, on_stage=None) -> str:
+    """Extract text from image using OCR (subject from detect_subject picks the language models directly)"""
+    if ocr_pool.busy:
+        print(f"[OCR] Queue full ({ocr_pool.pending} pending), asking user to retry")
+        return OCR_BUSY_MESSAGE
+
+    # Discord tells us the size up front - don't even start on huge files
+    if size and size > OCR_MAX_IMAGE_BYTES:
+        print(f"[OCR] Skipping {size} byte image (limit {OCR_MAX_IMAGE_BYTES})")
+        return OCR_TOO_BIG_MESSAGE
 
-                    # DEBUG: Print what OCR actually extracted
-                    print(f"[OCR DEBUG] Raw text extracted: '{text}'")
-                    print(f"[OCR DEBUG] Text length: {len(text.strip())}")
-                    sys.stdout.flush()
-
-                    if text.strip():
-                        # Clean up the text - remove excessive whitespace
-                        cleaned_text = ' '.join(text.split())
-                        print(f"[OCR DEBUG] Cleaned text: '{cleaned_text}'")
-                        sys.stdout.flush()
-                        return f"[Image contains text: {cleaned_text}]"
-                    else:
-                        print(f"[OCR DEBUG] No text found in image")
-                        sys.stdout.flush()
-                        return "[Image uploaded - no readable text detected. If you need help with this image, please describe what's in it or what you need help with.]"
-        return "[Could not process image]"
+    try:
+        if on_stage:
+            on_stage('download')
+        started = time.perf_counter()
+        image_data = await download_attachment(attachment_url, OCR_MAX_IMAGE_BYTES)
+        if image_data is DOWNLOAD_TOO_LARGE:
+            print(f"[OCR] Download passed the {OCR_MAX_IMAGE_BYTES} byte limit")
+            return OCR_TOO_BIG_MESSAGE
+        if image_data is None:
+            return "[Could not process image]"
+        download_ms = (time.perf_counter() - started) * 1000
+
+        # Same screenshot reposted (in another channel, a DM...) - skip OCR entirely
+        langs = OCR_SUBJECT_LANGS.get(subject)
+        # The language hint changes what tesseract reads, so it's part of the key
+        cache_key = f"{hashlib.sha256(image_data).hexdigest()}-{langs or 'auto'}"
+        cached = await ocr_cache.get(cache_key)
+        if cached is not None:
+            print(f"[OCR] Cache hit (hits={ocr_cache.hits}, misses={ocr_cache.misses})")
+            return cached
+
+        if on_stage:
+            on_stage('ocr')
+        text, timings = await ocr_pool.run(ocr_image_bytes, image_data, langs, timeout=OCR_TIMEOUT)
+
+        stages = ', '.join(f"{stage}={ms:.0f}ms" for stage, ms in timings.items())
+        print(f"[OCR] download={download_ms:.0f}ms, {stages}, queued={ocr_pool.pending}")
+
+        # DEBUG: Print what OCR actually extracted
+        print(f"[OCR DEBUG] Raw text extracted: '{text}'")
+        print(f"[OCR DEBUG] Text length: {len(text.strip())}")
+        sys.stdout.flush()
+
+        if text.strip():
+            # Clean up the text - remove excessive whitespace
+            cleaned_text = ' '.join(text.split())
+            print(f"[OCR DEBUG] Cleaned text: '{cleaned_text}'")
+            sys.stdout.flush()
+            description = f"[Image contains text: {cleaned_text}]"
+        else:
+            print(f"[OCR DEBUG] No text found in image")
+            sys.stdout.flush()
+            description = "[Image uploaded - no readable text detected. If you need help with this image, please describe what's in it or what you need help with.]"
+
+        await ocr_cache.put(cache_key, description)
+        return description
+    except PoolBusy:
+        return OCR_BUSY_MESSAGE
     except Exception as e:
         print(f"[ERROR] Image processing failed: {e}")
         sys.stdout.flush()
         return "[Image uploaded but couldn't process it - please describe what you need help with]"
 
-async def show_image_processing_animation(channel, mode: str):
-    """Show smooth animated loading message while processing image"""
-    if mode == "flirty":
-        messages = [
-            "hold on cutie",
-            "hold on cutie.",
-            "hold on cutie. .",
-            "hold on cutie. . .",
-            "hold on cutie. . . .",
-            "hold on cutie. . . . .",
-            "analyzing for you babe 💕",
-        ]
-    else:  # bestie mode
-        messages = [
-            "hold on bestie",
-            "hold on bestie.",
-            "hold on bestie. .",
-            "hold on bestie. . .",
-            "hold on bestie. . . .",
-            "hold on bestie. . . . .",
-            "analyzing this for you 👀",
-        ]
-    
-    processing_msg = await channel.send(messages[0])
-    
-    # Animate the dots
-    for msg in messages[1:]:
-        await asyncio.sleep(0.3)
-        await processing_msg.edit(content=msg)
-    
-    return processing_msg
+def get_image_attachments(message) -> list:
+    """Image attachments of a message, in the order they were uploaded"""
+    return [a for a in message.attachments if a.content_type and a.content_type.startswith('image/')]
+
+async def process_message_images(message, user_id: int, progress=None) -> str:
+    """OCR every image on a message at once and combine the results in upload order"""
+    images = get_image_attachments(message)
+    if not images:
+        return ""
+
+    batch = images[:OCR_MAX_IMAGES_PER_MESSAGE]
+    skipped = len(images) - len(batch)
+    subject = detect_subject(message.content)
+    print(f"[DEBUG] Processing {len(batch)} image(s) from user {user_id}" + (f", skipping {skipped}" if skipped else ""))
+
+    stages = ['download'] * len(batch)
+
+    def stage_tracker(index: int):
+        def on_stage(stage: str):
+            stages[index] = stage
+            if progress:
+                # Show the slowest page's stage, plus how many are done when there are several
+                done = sum(1 for s in stages if s == 'done')
+                pending = [s for s in stages if s != 'done']
+                detail = f" ({done}/{len(stages)} done)" if len(stages) > 1 else ""
+                progress.stage('download' if 'download' in pending else 'ocr', detail)
+        return on_stage
+
+    async def read(index: int, attachment) -> str:
+        description = await process_image(attachment.url, subject, attachment.size, stage_tracker(index))
+        stage_tracker(index)('done')
+        return description
+
+    async with message.channel.typing():
+        # gather keeps results in attachment order no matter which page finishes first
+        descriptions = await asyncio.gather(*(read(i, a) for i, a in enumerate(batch)))
+
+    if OCR_BUSY_MESSAGE in descriptions:
+        return OCR_BUSY_MESSAGE
+
+    if len(descriptions) == 1 and not skipped:
+        image_description = descriptions[0]
+    else:
+        total = len(images)
+        image_description = "\n".join(f"[Image {i} of {total}] {d}" for i, d in enumerate(descriptions, 1))
+        if skipped:
+            image_description += f"\n[{skipped} more image(s) not read - only the first {len(batch)} are processed per message]"
+
+    print(f"[DEBUG] Image processed: {image_description[:100]}")
+    return image_description
+
+progress_edit_times = {}  # channel id -> recent progress edit times, shared by every indicator in the channel
+
+class ProgressIndicator:
+    """Status message that runs alongside image work and is only edited when a pipeline stage actually changes"""
+
+    def __init__(self, channel, mode: str):
+        self.channel = channel
+        self.prefix = "hold on cutie" if mode == "flirty" else "hold on bestie"
+        self.text = f"{self.prefix}..."
+        self.shown = None
+        self.message = None
+        self.send_task = None
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def stage(self, stage: str, detail: str = ""):
+        """Report a stage from PROGRESS_STAGES - repeats are free, only real changes cost an edit"""
+        text = f"{self.prefix}... {PROGRESS_STAGES[stage]}{detail} 👀"
+        if text != self.text:
+            self.text = text
+            self.changed.set()
+
+    def _edit_wait(self) -> float:
+        """Seconds until the channel's edit budget has room (0 means take a slot now)"""
+        now = time.monotonic()
+        times = progress_edit_times.get(self.channel.id)
+        if times is None:
+            # Forget channels whose budget has fully recovered so the dict only holds recently busy ones
+            for channel_id in [cid for cid, t in progress_edit_times.items() if not t or now - t[-1] > PROGRESS_EDIT_WINDOW]:
+                del progress_edit_times[channel_id]
+            times = progress_edit_times[self.channel.id] = deque()
+        while times and now - times[0] > PROGRESS_EDIT_WINDOW:
+            times.popleft()
+        if len(times) < PROGRESS_EDIT_BUDGET:
+            times.append(now)
+            return 0
+        return PROGRESS_EDIT_WINDOW - (now - times[0])
+
+    async def _run(self):
+        try:
+            await asyncio.sleep(PROGRESS_DELAY)
+            # Shielded so closing mid-send still gets the message back to delete
+            self.send_task = asyncio.ensure_future(self.channel.send(self.text))
+            self.shown = self.text
+            self.message = await asyncio.shield(self.send_task)
+
+            while True:
+                await self.changed.wait()
+                self.changed.clear()
+                wait = self._edit_wait()
+                if wait:
+                    # Out of budget - stages that finish meanwhile collapse into one later edit
+                    await asyncio.sleep(wait)
+                    self.changed.set()
+                    continue
+                if self.text != self.shown:
+                    self.shown = self.text
+                    await self.message.edit(content=self.text)
+        except discord.HTTPException as e:
+            print(f"[ERROR] Progress update failed: {e}")
+
+    async def close(self):
+        """Stop updating and remove the status message if one was posted - safe to call twice"""
+        if self.task.done() and self.send_task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        send_task, self.send_task = self.send_task, None
+        if send_task is None:
+            return
+        try:
+            await (await send_task).delete()
+        except discord.HTTPException as e:
+            print(f"[ERROR] Couldn't remove progress message: {e}")
+
+# Cheap lexical gate in front of sympy - casual chat like "ok = cool" never reaches the parser
+MATH_KEYWORD_PATTERN = re.compile(r"\b(?:derivative|differentiate|integral|integrate|simplify|solve|lim|limit|evaluate|calculate|compute|what is|what's|whats)\b|d/d[a-z]|∫")
+_MATH_OPERAND = r'(?:\d|\b[a-z]\b|[)²³])'
+MATH_EXPRESSION_PATTERN = re.compile(
+    _MATH_OPERAND + r'\s*(?:\*\*|[-+*/^=×÷−])\s*(?:\d|\b[a-z]\b|[(√]|(?:sin|cos|tan|sec|csc|cot|exp|log|ln|sqrt)\b)'
+    r'|\d\s*[a-z]\b'                                                           # 2x, 3 y
+    r'|\b(?:sin|cos|tan|sec|csc|cot|exp|log|ln|sqrt)\b\s*\(?\s*(?:\d|\b[a-z]\b)'  # sin x, ln(2)
+    r'|\b[a-z]\s*[²³]|√'
+)
+math_filter_stats = {'checked': 0, 'math': 0}
 
-def solve_math_problem(problem_text: str) -> tuple:
-    """Solves math problems and returns (text_solution, has_math)"""
-    try:
-        problem_text = problem_text.lower().strip()
+def looks_like_math(text: str) -> bool:
+    """True when a lowercased message has a math keyword or '=' next to something that actually looks like an expression"""
+    math_filter_stats['checked'] += 1
+    if not (('=' in text or MATH_KEYWORD_PATTERN.search(text)) and MATH_EXPRESSION_PATTERN.search(text)):
+        return False
+    math_filter_stats['math'] += 1
+    print(f"[DEBUG] Math filter passed {math_filter_stats['math']}/{math_filter_stats['checked']} messages so far")
+    return True
+
+@functools.lru_cache(maxsize=MATH_CACHE_SIZE)
+def _parse_math(expr_text: str, evaluate: bool):
+    return parse_expr(expr_text, local_dict=MATH_LOCALS, transformations=MATH_TRANSFORMATIONS, evaluate=evaluate)
+
+def parse_math(expr_text: str, evaluate: bool = True):
+    """parse_expr with the bot's transformations, memoised on whitespace-normalised text"""
+    for word in MATH_WORD_PATTERN.findall(expr_text):
+        # "x = 4 on number 3" would otherwise come back as x = 12*b*e*m*n**2*o*r*u; xy is still x*y
+        if word not in MATH_WORDS and set(word) - set('xyz'):
+            raise ValueError(f"'{word}' isn't math")
+    return _parse_math(' '.join(expr_text.split()), evaluate)
+
+_math_results = OrderedDict()
+
+def cached_math(operation: str, expr, compute):
+    """compute(expr), memoised on the expression's srepr so differently typed copies of a problem share one answer"""
+    key = (operation, sympy.srepr(expr))
+    if key in _math_results:
+        _math_results.move_to_end(key)
+        return _math_results[key]
+
+    result = compute(expr)
+    _math_results[key] = result
+    if len(_math_results) > MATH_CACHE_SIZE:
+        _math_results.popitem(last=False)
+    return result
+
+# Pieces of a problem the engine pulls out before handing the rest to sympy
+MATH_SYMBOL_REPLACEMENTS = str.maketrans({'−': '-', '×': '*', '÷': '/', '·': '*', '²': '**2', '³': '**3', '∞': 'oo', 'π': 'pi'})
+MATH_SQRT_PATTERN = re.compile(r'√\s*(\d+(?:\.\d+)?|[a-z]\b)')
+MATH_INFINITY_PATTERN = re.compile(r'\binf(?:inity)?\b')
+MATH_LIMIT_PATTERN = re.compile(
+    r'\blim(?:it)?\b(?:\s+of)?\s+(?P<expr>.+?)\s+as\s+(?P<var>[a-z])\s*(?:->|→|approaches|goes to|tends to)\s*(?P<point>[^\s,?]+)'
+    r'(?:\s+from\s+the\s+(?P<side>left|right))?'
+)
+MATH_LIMIT_PREFIX_PATTERN = re.compile(
+    r'\blim(?:it)?\s+(?:as\s+)?(?P<var>[a-z])\s*(?:->|→|approaches|goes to|tends to)\s*(?P<point>[^\s,]+)\s+(?:of\s+)?(?P<expr>.+)'
+)
+MATH_BOUNDS_PATTERN = re.compile(r'\s+from\s+(?P<lower>.+?)\s+to\s+(?P<upper>.+?)\s*$')
+MATH_RESPECT_PATTERN = re.compile(r'\s*\b(?:with respect to|wrt|w\.r\.t\.?)\s+(?P<var>[a-z])\b')
+MATH_DDX_PATTERN = re.compile(r'd/d(?P<var>[a-z])\b')
+MATH_DIFFERENTIAL_PATTERN = re.compile(r'\s*\bd(?P<var>[a-z])\s*$')
+MATH_SOLVE_FOR_PATTERN = re.compile(r'\s*\bfor\s+(?P<vars>[a-z](?:\s*(?:,|and)\s*[a-z])*)\s*$')
+MATH_SOLVE_FOR_LEADING_PATTERN = re.compile(
+    r'\b(?:solve\s+for|find)\s+(?P<vars>[a-z](?:\s*(?:,|and)\s*[a-z])*)\b\s*(?::|,|\b(?:if|when|where|given(?: that)?|such that)\b)?\s*'
+)
+MATH_EQUATION_SPLIT_PATTERN = re.compile(r'\s*(?:,|;|\band\b)\s*')
+MATH_EVALUATE_PATTERN = re.compile(r"\b(?:evaluate|calculate|compute|what is|what's|whats)\b")
+MATH_SOURCE_POWER_PATTERN = re.compile(r'\s*(?:\*\*|\^)\s*(?:\((?P<group>[^()]*)\)|(?P<atom>[\w.]+))')
+MATH_SOURCE_SQRT_PATTERN = re.compile(r'sqrt\(([^()]*)\)')
+MATH_WORD_PATTERN = re.compile(r'[a-z]{2,}')
+MATH_SOLVE_PREFIX_PATTERN = re.compile(r'\bsolve\b(?:\s+(?:this|the following))?\s*:?')
+
+def normalize_math_text(text: str) -> str:
+    """Unicode operators, √ and 'infinity' rewritten into something parse_expr understands"""
+    text = MATH_SQRT_PATTERN.sub(r'sqrt(\1)', text.translate(MATH_SYMBOL_REPLACEMENTS)).replace('√', 'sqrt')
+    return MATH_INFINITY_PATTERN.sub('oo', text)
+
+def strip_trailing_words(text: str) -> str:
+    """'2x + 3 = 7 pls thanks!' -> '2x + 3 = 7' - chat after a problem, stopping at math words and differentials (dx)"""
+    words = text.rstrip('?.!, ').split(' ')
+    while len(words) > 1:
+        word = words[-1].rstrip('?.!,')
+        if not MATH_WORD_PATTERN.fullmatch(word) or word in MATH_WORDS or re.fullmatch(r'd[a-z]', word):
+            break
+        words.pop()
+    return ' '.join(words).rstrip('?.!, ')
+
+def undefined_value(value) -> bool:
+    """True for results that aren't a number at all - zoo (1/0), nan (0/0) or a limit that only has bounds"""
+    return isinstance(value, sympy.Basic) and value.has(sympy.zoo, sympy.nan, sympy.AccumBounds)
+
+def math_operand(text: str, keyword_pattern: str) -> str:
+    """The expression part of a request: whatever follows ' of ', else whatever follows the keyword"""
+    if ' of ' in text:
+        text = text.split(' of ')[-1]
+    else:
+        text = re.split(keyword_pattern, text, maxsplit=1)[-1]
+    return text.strip().rstrip('?.!').removeprefix('the ').strip()
+
+def pick_variable(expr, preferred: str = None):
+    """The variable to work in: the one asked for, else x, else the first free symbol"""
+    if preferred:
+        return symbols(preferred)
+    free = sorted(expr.free_symbols, key=lambda s: s.name)
+    for symbol in free:
+        if symbol.name == 'x':
+            return symbol
+    return free[0] if free else symbols('x')
+
+def numeric_note(value) -> str:
+    """' ≈ 0.333333' for exact non-integer numbers, '' otherwise"""
+    if getattr(value, 'is_number', False) and not value.is_Integer and value.is_finite:
+        return f" ≈ {sympy.N(value, 6)}"
+    return ""
+
+def derivative_rules(expr, var) -> list:
+    """Names of the differentiation rules an expression needs, for the step outline"""
+    rules = []
+    if expr.is_Add:
+        rules.append("sum rule")
+    for node in sympy.preorder_traversal(expr):
+        if node.is_Mul and sum(1 for factor in node.args if factor.has(var)) > 1:
+            rule = "quotient rule" if any(f.is_Pow and f.exp.is_negative and f.base.has(var) for f in node.args) else "product rule"
+        elif node.is_Pow and node.base.has(var) and not node.exp.has(var):
+            rule = "power rule" if node.base == var else "chain rule"
+        elif node.is_Pow and node.exp.has(var) or isinstance(node, sympy.exp):
+            rule = "exponential rule"
+        elif isinstance(node, sympy.Function) and node.args and node.args[0] != var and node.args[0].has(var):
+            rule = "chain rule"
+        else:
+            continue
+        if rule not in rules:
+            rules.append(rule)
+    return rules or ["constant/basic rules"]
+
+def math_derivative(text: str):
+    var_name = None
+    match = MATH_RESPECT_PATTERN.search(text) or MATH_DDX_PATTERN.search(text)
+    if match:
+        var_name = match.group('var')
+        text = MATH_RESPECT_PATTERN.sub('', text)
+    expr = parse_math(math_operand(text, r'derivative|differentiate|d/d[a-z]'))
+    var = pick_variable(expr, var_name)
+    result = cached_math(f'diff:{var}', expr, lambda e: sympy.simplify(diff(e, var)))
+
+    steps = [f"apply the {', '.join(derivative_rules(expr, var))} to d/d{var}({expr})", f"simplify to {result}"]
+    return (f"d/d{var}({expr}) = {result}", fr"\frac{{d}}{{d{var}}}\left({latex(expr)}\right) = {latex(result)}", steps)
+
+def math_integral(text: str):
+    text = text.replace('∫', ' integral of ')
+    bounds = MATH_BOUNDS_PATTERN.search(text)
+    if bounds:
+        text = text[:bounds.start()]
+    operand = math_operand(text, r'integral|integrate')
+    var_name = None
+    differential = MATH_DIFFERENTIAL_PATTERN.search(operand)
+    if differential:
+        var_name = differential.group('var')
+        operand = operand[:differential.start()]
+    expr = parse_math(operand)
+    var = pick_variable(expr, var_name)
+    antiderivative = cached_math(f'integrate:{var}', expr, lambda e: integrate(e, var))
+
+    if not bounds:
+        steps = [f"find F({var}) whose derivative is {expr}", f"F({var}) = {antiderivative}", "add the constant of integration C"]
+        return (f"∫({expr})d{var} = {antiderivative} + C", fr"\int {latex(expr)}\, d{var} = {latex(antiderivative)} + C", steps)
+
+    lower, upper = parse_math(bounds.group('lower')), parse_math(bounds.group('upper'))
+    result = cached_math(f'integrate:{var}:{lower}:{upper}', expr, lambda e: integrate(e, (var, lower, upper)))
+    if undefined_value(result):
+        steps = [f"antiderivative F({var}) = {antiderivative}", f"{expr} blows up between {lower} and {upper}", "the integral diverges"]
+        return (
+            f"∫ from {lower} to {upper} of ({expr})d{var} diverges",
+            fr"\int_{{{latex(lower)}}}^{{{latex(upper)}}} {latex(expr)}\, d{var}\ \text{{diverges}}",
+            steps,
+        )
+    steps = [
+        f"antiderivative F({var}) = {antiderivative}",
+        f"evaluate F({upper}) - F({lower})",
+        f"result {result}{numeric_note(result)}",
+    ]
+    return (
+        f"∫ from {lower} to {upper} of ({expr})d{var} = {result}{numeric_note(result)}",
+        fr"\int_{{{latex(lower)}}}^{{{latex(upper)}}} {latex(expr)}\, d{var} = {latex(result)}",
+        steps,
+    )
 
-        if 'derivative' in problem_text or 'differentiate' in problem_text or "d/dx" in problem_text:
-            if ' of ' in problem_text:
-                expr_text = problem_text.split(' of ')[-1].strip()
-            else:
-                expr_text = problem_text
+def math_limit(match):
+    expr = parse_math(match.group('expr'))
+    var = symbols(match.group('var'))
+    point = parse_math(match.group('point'))
+    side = {'left': '-', 'right': '+'}.get(match.groupdict().get('side'), '+-')
+    if point.is_infinite:
+        side = '-' if point.is_extended_positive else '+'
+    result = cached_math(f'limit:{var}:{point}:{side}', expr, lambda e: limit(e, var, point, side))
+
+    substituted = expr.subs(var, point) if point.is_finite else None
+    if substituted is not None and substituted.is_finite and not substituted.has(sympy.nan):
+        how = f"direct substitution of {var} = {point} works"
+    else:
+        how = "direct substitution is indeterminate, so simplify / compare growth rates (or use L'Hôpital)"
+    arrow = {'-': '^-', '+': '^+'}.get(side, '') if point.is_finite else ''
+    shown = f"lim {var}->{point}{'' if side == '+-' or not point.is_finite else side} of {expr}"
+    if undefined_value(result):
+        steps = [how, "the one-sided limits disagree or it oscillates, so the limit does not exist"]
+        return (f"{shown} does not exist", fr"\lim_{{{var} \to {latex(point)}{arrow}}} {latex(expr)}\ \text{{does not exist}}", steps)
+    steps = [how, f"limit is {result}{numeric_note(result)}"]
+    return (
+        f"{shown} = {result}{numeric_note(result)}",
+        fr"\lim_{{{var} \to {latex(point)}{arrow}}} {latex(expr)} = {latex(result)}",
+        steps,
+    )
 
-            x = symbols('x')
-            expr = parse_expr(expr_text, transformations=(standard_transformations + (implicit_multiplication_application,)))
-            result = diff(expr, x)
+def math_solve(text: str):
+    var_names = None
+    leading = MATH_SOLVE_FOR_LEADING_PATTERN.search(text)
+    solve_for = MATH_SOLVE_FOR_PATTERN.search(text)
+    if leading and '=' in text[leading.end():]:
+        # "solve for x: 3x - 5 = 10", "find x if 2x + 1 = 9"
+        var_names = re.findall(r'\b[a-z]\b', leading.group('vars'))
+        text = text[leading.end():]
+    elif solve_for:
+        var_names = re.findall(r'\b[a-z]\b', solve_for.group('vars'))
+        text = text[:solve_for.start()]
+    text = MATH_SOLVE_PREFIX_PATTERN.split(text, maxsplit=1)[-1].strip().rstrip('?.!')
+
+    equations = []
+    for part in MATH_EQUATION_SPLIT_PATTERN.split(text):
+        if part.count('=') == 1:
+            lhs, rhs = part.split('=')
+            equations.append(sympy.Eq(parse_math(lhs), parse_math(rhs)))
+    if not equations:
+        return None
 
-            return (f"d/dx({expr}) = {result}", True)
+    unknowns = sorted(set().union(*(eq.free_symbols for eq in equations)), key=lambda s: s.name)
+    if var_names:
+        unknowns = [symbols(name) for name in var_names]
+    elif len(equations) == 1:
+        unknowns = [pick_variable(equations[0])]
+    system = sympy.Tuple(*equations)
+
+    if len(equations) == 1:
+        var = unknowns[0]
+        result = cached_math(f'solve:{var}', system, lambda e: solve(e[0], var))
+        plain = " or ".join(f"{var} = {r}{numeric_note(r)}" for r in result) if result else f"no solution for {var}"
+        tex = f"{latex(equations[0])} \\Rightarrow {var} = {', '.join(latex(r) for r in result)}" if result else latex(equations[0])
+        steps = [f"move everything to one side: {equations[0].lhs - equations[0].rhs} = 0", f"solve for {var}", plain]
+        return (plain, tex, steps)
+
+    result = cached_math(f'solve:{unknowns}', system, lambda e: solve(list(e), unknowns, dict=True))
+    if not result:
+        plain = "the system has no solution"
+    else:
+        plain = " or ".join(", ".join(f"{k} = {v}" for k, v in solution.items()) for solution in result)
+    tex = r",\quad ".join(latex(eq) for eq in equations)
+    if result:
+        tex += r" \Rightarrow " + r"\ \mathrm{or}\ ".join(r",\ ".join(f"{latex(k)} = {latex(v)}" for k, v in solution.items()) for solution in result)
+    steps = [
+        f"{len(equations)} equations in {', '.join(map(str, unknowns))}",
+        "substitute / eliminate one unknown at a time",
+        plain,
+    ]
+    return (plain, tex, steps)
+
+def math_simplify(text: str):
+    expr = parse_math(math_operand(text, r'simplify'))
+    result = cached_math('simplify', expr, simplify)
+    steps = ["factor numerator and denominator, cancel common factors, combine like terms", f"{expr} = {result}"]
+    return (f"{expr} = {result}", f"{latex(expr)} = {latex(result)}", steps)
+
+def math_source_latex(text: str) -> str:
+    """The expression as typed, in LaTeX - sympy would reorder '2/3+1/4' and print it as 1 \\cdot \\frac{1}{4} + ..."""
+    text = MATH_SOURCE_SQRT_PATTERN.sub(r'\\sqrt{\1}', ' '.join(text.split()))
+    text = MATH_SOURCE_POWER_PATTERN.sub(lambda m: f"^{{{m.group('group') if m.group('group') is not None else m.group('atom')}}}", text)
+    text = re.sub(r'\bpi\b', r'\\pi', text).replace('oo', r'\infty')
+    return re.sub(r'\s*\*\s*', r' \\cdot ', text)
+
+def math_evaluate(text: str):
+    operand = re.split(MATH_EVALUATE_PATTERN, text, maxsplit=1)[-1].strip().rstrip('?.!=').strip()
+    expr = parse_math(operand, evaluate=False)
+    if expr.free_symbols:
+        return None
+    result = cached_math('evaluate', parse_math(operand), simplify)
+    if undefined_value(result):
+        steps = ["no finite value - division by zero or an indeterminate form like 0/0"]
+        return (f"{operand} is undefined", fr"{math_source_latex(operand)}\ \text{{is undefined}}", steps)
+    steps = [f"exact value {result}{numeric_note(result)}"]
+    return (f"{operand} = {result}{numeric_note(result)}", f"{math_source_latex(operand)} = {latex(result)}", steps)
 
+def solve_math_problem(problem_text: str) -> tuple:
+    """Solves math problems and returns (text_solution, has_math, latex) - text has the answer, its LaTeX and a step outline"""
+    try:
+        problem_text = normalize_math_text(problem_text.lower().strip())
+
+        limit_match = MATH_LIMIT_PATTERN.search(problem_text) or MATH_LIMIT_PREFIX_PATTERN.search(problem_text)
+        if not limit_match:
+            # "solve 2x + 3 = 7 pls" - limits keep their tail, it can be "from the left"
+            problem_text = strip_trailing_words(problem_text)
+        if limit_match:
+            solution = math_limit(limit_match)
+        elif 'derivative' in problem_text or 'differentiate' in problem_text or MATH_DDX_PATTERN.search(problem_text):
+            solution = math_derivative(problem_text)
         elif 'integral' in problem_text or 'integrate' in problem_text or '∫' in problem_text:
-            if ' of ' in problem_text:
-                expr_text = problem_text.split(' of ')[-1].strip()
-            else:
-                expr_text = problem_text
+            solution = math_integral(problem_text)
+        elif 'simplify' in problem_text:
+            solution = math_simplify(problem_text)
+        elif '=' in problem_text.rstrip('=? '):
+            solution = math_solve(problem_text)
+        elif MATH_EVALUATE_PATTERN.search(problem_text):
+            solution = math_evaluate(problem_text)
+        else:
+            solution = None
 
-            x = symbols('x')
-            expr = parse_expr(expr_text, transformations=(standard_transformations + (implicit_multiplication_application,)))
-            result = integrate(expr, x)
+        if solution is None:
+            return (None, False, None)
 
-            return (f"∫({expr})dx = {result} + C", True)
+        plain, tex, steps = solution
+        outline = "; ".join(f"{i}) {step}" for i, step in enumerate(steps, 1))
+        return (f"{plain} | LaTeX: {tex} | Steps: {outline}", True, tex)
 
-        elif 'solve' in problem_text or '=' in problem_text:
-            if '=' in problem_text:
-                parts = problem_text.split('=')
-                if len(parts) == 2:
-                    x = symbols('x')
-                    lhs = parse_expr(parts[0].strip(), transformations=(standard_transformations + (implicit_multiplication_application,)))
-                    rhs = parse_expr(parts[1].strip(), transformations=(standard_transformations + (implicit_multiplication_application,)))
-                    result = solve(lhs - rhs, x)
+    except MemoryError:
+        raise
+    except Exception as e:
+        print(f"Math solving error: {e}")
+        return (None, False, None)
 
-                    return (f"x = {result}", True)
+def solve_math_worker(problem_text: str, timeout: float) -> tuple:
+    """Runs in a math worker - solve_math_problem under an alarm, (MATH_TOO_HARD, True, None) if it blows the budget"""
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return solve_math_problem(problem_text)
+    except (MathTimeout, MemoryError) as e:
+        print(f"[DEBUG] Math gave up ({type(e).__name__}): '{problem_text[:50]}'")
+        return (MATH_TOO_HARD, True, None)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+math_answers = OrderedDict()  # normalised problem text -> (solution, has_math, latex), skips the worker round trip
+
+async def solve_math_async(problem_text: str) -> tuple:
+    """solve_math_problem off the event loop - never lets one problem stall the bot"""
+    key = ' '.join(problem_text.lower().split())
+    if key in math_answers:
+        math_answers.move_to_end(key)
+        return math_answers[key]
 
-        elif 'simplify' in problem_text:
-            if ' simplify ' in problem_text:
-                expr_text = problem_text.split('simplify')[-1].strip()
-            else:
-                expr_text = problem_text
+    try:
+        # The in-worker alarm should always fire first; wait_for is the backstop for C code ignoring signals
+        answer = await math_pool.run(solve_math_worker, problem_text, MATH_TIMEOUT, timeout=MATH_TIMEOUT + 2)
+    except asyncio.TimeoutError:
+        answer = (MATH_TOO_HARD, True, None)
+    except BrokenProcessPool:
+        # Worker was killed - by this job's memory limit or a neighbour's timeout, so don't cache it
+        return (MATH_TOO_HARD, True, None)
+    except PoolBusy:
+        print(f"[DEBUG] Math pool busy ({math_pool.pending} pending), skipping solver")
+        return (None, False, None)
+
+    # Too-hard answers are cached as well - no point burning another worker on the same problem
+    math_answers[key] = answer
+    if len(math_answers) > MATH_CACHE_SIZE:
+        math_answers.popitem(last=False)
+    return answer
+
+def render_latex_png(tex: str, dpi: int):
+    """Runs in a math worker - mathtext render of one LaTeX line to PNG bytes, None if matplotlib can't draw it"""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import mathtext
+        buffer = io.BytesIO()
+        mathtext.math_to_image(f"${tex}$", buffer, dpi=dpi, format='png')
+        return buffer.getvalue()
+    except Exception as e:
+        print(f"[DEBUG] Couldn't render '{tex[:50]}': {e}")
+        return None
 
-            expr = parse_expr(expr_text, transformations=(standard_transformations + (implicit_multiplication_application,)))
-            result = simplify(expr)
+@functools.cache
+def math_render_available() -> bool:
+    if not MATH_RENDER:
+        return False
+    import importlib.util
+    if importlib.util.find_spec('matplotlib') is None:
+        print("[DEBUG] matplotlib not installed, math images disabled")
+        return False
+    return True
 
-            return (f"{expr} = {result}", True)
+math_renders = OrderedDict()  # sha256 of the LaTeX -> PNG bytes (or None when mathtext couldn't draw it)
 
-        return (None, False)
+async def render_math_image(tex: str):
+    """PNG of a solved problem's LaTeX, rendered in the math pool and cached by expression hash"""
+    if not tex or not math_render_available():
+        return None
 
-    except Exception as e:
-        print(f"Math solving error: {e}")
-        return (None, False)
+    key = hashlib.sha256(tex.encode()).hexdigest()
+    if key in math_renders:
+        math_renders.move_to_end(key)
+        return math_renders[key]
 
-def get_user_mode(user_id: int) -> str:
-    if user_id not in user_modes:
-        user_modes[user_id] = {
-            "mode": "bestie",
-            "last_activity": datetime.now(),
-            "session_active": False,
-            "teaching_mode": False
-        }
-        return "bestie"
+    try:
+        png = await math_pool.run(render_latex_png, tex, MATH_RENDER_DPI, timeout=MATH_TIMEOUT + 2)
+    except (PoolBusy, asyncio.TimeoutError, BrokenProcessPool):
+        return None
+
+    math_renders[key] = png
+    if len(math_renders) > MATH_RENDER_CACHE_SIZE:
+        math_renders.popitem(last=False)
+    return png
 
-    user_data = user_modes[user_id]
-    time_since_activity = datetime.now() - user_data["last_activity"]
+async def send_math_image(message: Message, render_task, is_dm: bool):
+    """Attach the rendered math under a reply once the render task is done"""
+    png = await render_task
+    if not png:
+        return
+    math_file = discord.File(io.BytesIO(png), filename="math.png")
+    if is_dm:
+        await message.channel.send(file=math_file)
+    else:
+        await message.reply(file=math_file, mention_author=False)
+
+def get_user_mode(user_id: int) -> str:
+    session = sessions.get_or_create(user_id)
 
-    if time_since_activity > MODE_TIMEOUT:
-        user_modes[user_id]["mode"] = "bestie"
-        user_modes[user_id]["session_active"] = False
-        user_modes[user_id]["teaching_mode"] = False
-        if user_id in conversation_active:
-            del conversation_active[user_id]
-        if user_id in user_histories:
-            del user_histories[user_id]
+    if datetime.now() - session.last_activity > MODE_TIMEOUT:
+        session.expire()
 
-    return user_modes[user_id]["mode"]
+    return session.mode
 
 def is_teaching_mode(user_id: int) -> bool:
-    if user_id not in user_modes:
-        return False
-    return user_modes[user_id].get("teaching_mode", False)
+    session = sessions.get(user_id)
+    return session.teaching_mode if session else False
 
 def set_teaching_mode(user_id: int, enabled: bool):
-    if user_id not in user_modes:
-        user_modes[user_id] = {
-            "mode": "bestie",
-            "last_activity": datetime.now(),
-            "session_active": False,
-            "teaching_mode": False
-        }
-    user_modes[user_id]["teaching_mode"] = enabled
-    user_modes[user_id]["last_activity"] = datetime.now()
+    session = sessions.get_or_create(user_id)
+    session.teaching_mode = enabled
+    session.last_activity = datetime.now()
 
 def update_user_activity(user_id: int):
-    if user_id in user_modes:
-        user_modes[user_id]["last_activity"] = datetime.now()
-    else:
-        user_modes[user_id] = {
-            "mode": "bestie",
-            "last_activity": datetime.now(),
-            "session_active": False,
-            "teaching_mode": False
-        }
+    sessions.get_or_create(user_id).last_activity = datetime.now()
 
 def set_user_mode(user_id: int, mode: str):
     if mode == "flirty":
@@ -411,170 +2095,236 @@ def set_user_mode(user_id: int, mode: str):
     else:
         actual_mode = mode
 
-    if user_id not in user_modes:
-        user_modes[user_id] = {
-            "mode": actual_mode,
-            "last_activity": datetime.now(),
-            "session_active": True,
-            "teaching_mode": False
-        }
-    else:
-        user_modes[user_id]["mode"] = actual_mode
-        user_modes[user_id]["last_activity"] = datetime.now()
-        user_modes[user_id]["session_active"] = True
+    session = sessions.get_or_create(user_id)
+    session.mode = actual_mode
+    session.last_activity = datetime.now()
+    session.session_active = True
 
     return actual_mode
 
-def get_time_context() -> str:
-    eastern = pytz.timezone('US/Eastern')
-    now = datetime.now(eastern)
-    hour = now.hour
-    day = now.strftime('%A')
-    time_str = now.strftime('%-I:%M %p')
+def get_time_period(hour: int = None) -> str:
+    if hour is None:
+        hour = datetime.now(EASTERN).hour
 
-    time_period = ""
     if 6 <= hour < 11:
-        time_period = "morning"
+        return "morning"
     elif 11 <= hour < 13:
-        time_period = "midday/lunch time"
+        return "midday/lunch time"
     elif 13 <= hour < 17:
-        time_period = "afternoon"
+        return "afternoon"
     elif 17 <= hour < 24:
-        time_period = "evening/night"
+        return "evening/night"
     else:
-        time_period = "very late night/early morning"
+        return "very late night/early morning"
 
-    return f"Current time: {time_str} on {day} ({time_period})"
+_time_context_cache = (None, "")
 
-def detect_teaching_request(user_message: str) -> bool:
-    teaching_keywords = [
+def get_time_context() -> str:
+    global _time_context_cache
+
+    # The line only has minute resolution, so build it once per minute
+    minute = int(time.time() // 60)
+    if _time_context_cache[0] == minute:
+        return _time_context_cache[1]
+
+    now = datetime.now(EASTERN)
+    day = now.strftime('%A')
+    time_str = now.strftime('%-I:%M %p')
+    time_period = get_time_period(now.hour)
+
+    time_context = f"Current time: {time_str} on {day} ({time_period})"
+    _time_context_cache = (minute, time_context)
+    return time_context
+
+# Every keyword list the bot reacts to, matched in one pass by keyword_matcher
+MESSAGE_KEYWORDS = {
+    'teaching': [
         'teach me', 'explain', 'how does', 'what is', 'help me understand',
         'i dont understand', "i don't understand", 'can you explain',
         'help with', 'confused about', 'what are', 'how do', 'solve',
         'stoichiometry', 'derivative', 'integral', 'calculate', 'balance equation',
         'velocity', 'acceleration', 'momentum', 'photosynthesis', 'mitosis',
         'how to say', 'translate', 'conjugate', 'grammar'
-    ]
+    ],
+    'french': ['french', 'français', 'en français', 'comment dit-on', 'parler français'],
+    'spanish': ['spanish', 'español', 'en español', 'cómo se dice', 'hablar español'],
+    'chinese': ['chinese', '中文', 'mandarin', '普通话', 'pinyin'],
+    'calculus': ['derivative', 'integral', 'calculus', 'limit', 'tangent', 'optimization'],
+    'algebra': ['algebra', 'equation', 'solve for', 'factor', 'polynomial', 'quadratic'],
+    'statistics': ['statistics', 'probability', 'mean', 'median', 'standard deviation', 'z-score'],
+    'chemistry': ['chemistry', 'stoichiometry', 'mole', 'chemical', 'reaction', 'element', 'compound', 'balance'],
+    'physics': ['physics', 'force', 'velocity', 'acceleration', 'energy', 'momentum', 'newton', 'kinematics'],
+    'biology': ['biology', 'cell', 'mitosis', 'dna', 'photosynthesis', 'organism', 'ecosystem'],
+    'insult': ["stupid", "dumb", "idiot", "suck", "trash", "useless"],
+    'aggressive': ["shut up", "stfu", "fuck you", "hate you", "go away"],
+    'bot_accusation': ["are you a bot", "you're a bot", "ur a bot"],
+}
+# First match wins when a message mentions several subjects
+SUBJECT_PRIORITY = ('french', 'spanish', 'chinese', 'calculus', 'algebra', 'statistics', 'chemistry', 'physics', 'biology')
+
+def is_word_char(ch: str) -> bool:
+    """Latin letters/digits only - CJK keywords have no word boundaries to respect"""
+    return ch.isalnum() and ord(ch) < 0x250
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over all keyword lists - one scan of a message finds every category it hits"""
+
+    def __init__(self, categories: dict):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for category, keywords in categories.items():
+            for keyword in keywords:
+                state = 0
+                for ch in keyword:
+                    if ch not in self.goto[state]:
+                        self.goto[state][ch] = len(self.goto)
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.outputs.append([])
+                    state = self.goto[state][ch]
+                # Boundary checks only apply to edges that are letters/digits
+                self.outputs[state].append((keyword, category, len(keyword), is_word_char(keyword[0]), is_word_char(keyword[-1])))
+
+        # Breadth-first so every state's failure link is final before its children need it
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def scan(self, text: str) -> dict:
+        """Category -> keywords found in text (expects lowercase) - 'cell' never fires inside 'excellent', 'cells' still counts"""
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        length = len(text)
+        found = {}
+        state = 0
+        for index, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for keyword, category, size, check_start, check_end in outputs[state]:
+                start, end = index - size + 1, index + 1
+                if check_start and start > 0 and is_word_char(text[start - 1]):
+                    continue
+                if check_end and end < length and is_word_char(text[end]):
+                    # Allow a plural s, nothing longer
+                    if text[end] != 's' or (end + 1 < length and is_word_char(text[end + 1])):
+                        continue
+                found.setdefault(category, []).append(keyword)
+        return found
+
+keyword_matcher = KeywordMatcher(MESSAGE_KEYWORDS)
+
+@functools.lru_cache(maxsize=1024)
+def classify_message(user_message: str) -> frozenset:
+    """Keyword categories a message hits - teaching, each subject, insult, aggressive, bot_accusation"""
+    return frozenset(keyword_matcher.scan(user_message.lower().replace('’', "'")))
 
-    user_lower = user_message.lower()
-    return any(keyword in user_lower for keyword in teaching_keywords)
+def detect_teaching_request(user_message: str) -> bool:
+    return 'teaching' in classify_message(user_message)
 
 def detect_subject(user_message: str) -> str:
-    user_lower = user_message.lower()
-
-    if any(word in user_lower for word in ['french', 'français', 'en français', 'comment dit-on', 'parler français']):
-        return 'french'
-    elif any(word in user_lower for word in ['spanish', 'español', 'en español', 'cómo se dice', 'hablar español']):
-        return 'spanish'
-    elif any(word in user_lower for word in ['chinese', '中文', 'mandarin', '普通话', 'pinyin']):
-        return 'chinese'
-    elif any(word in user_lower for word in ['derivative', 'integral', 'calculus', 'limit', 'tangent', 'optimization']):
-        return 'calculus'
-    elif any(word in user_lower for word in ['algebra', 'equation', 'solve for', 'factor', 'polynomial', 'quadratic']):
-        return 'algebra'
-    elif any(word in user_lower for word in ['statistics', 'probability', 'mean', 'median', 'standard deviation', 'z-score']):
-        return 'statistics'
-    elif any(word in user_lower for word in ['chemistry', 'stoichiometry', 'mole', 'chemical', 'reaction', 'element', 'compound', 'balance']):
-        return 'chemistry'
-    elif any(word in user_lower for word in ['physics', 'force', 'velocity', 'acceleration', 'energy', 'momentum', 'newton', 'kinematics']):
-        return 'physics'
-    elif any(word in user_lower for word in ['biology', 'cell', 'mitosis', 'dna', 'photosynthesis', 'organism', 'ecosystem']):
-        return 'biology'
+    categories = classify_message(user_message)
+    for subject in SUBJECT_PRIORITY:
+        if subject in categories:
+            return subject
 
     return 'general'
 
-def get_system_prompt(mode: str, teaching_mode: bool, subject: str = 'general', context: str = None) -> str:
-    time_context = get_time_context()
-
-    base_personality = f"""You are "abg tutor," a 19-year-old SoCal girl at UC Berkeley who tutors students in APs, SAT, and ACT.
+PROMPT_HEADER = """You are "abg tutor," a 19-year-old SoCal girl at UC Berkeley who tutors students in APs, SAT, and ACT.
 You type in lowercase and talk like someone texting a friend. You're emotionally intelligent and helpful.
 You use slang naturally ("fr," "ngl," "tbh," "nah," "ok but like," "lmao," "ugh," "bruh," "lowkey").
 Use emojis occasionally but LIMIT TO ONLY ONE EMOJI PER MESSAGE. Don't overdo it with emojis.
 
-{time_context}
+"""
+
+PROMPT_CONTEXT_RULES = """
 
 CRITICAL CONTEXT UNDERSTANDING:
 - Before responding, understand the CONTEXT of what the user is asking
 - Determine: Is this ACADEMIC or CASUAL/SOCIAL?
 - Respond appropriately based on that determination"""
 
-    subject_instruction = ""
-    if subject == 'french':
-        subject_instruction = """
+MATH_INSTRUCTION = """
+📐 MATH MODE:
+- Show your work step-by-step
+- Use mathematical notation when helpful
+- Explain WHY each step is taken, not just HOW
+"""
+
+SUBJECT_INSTRUCTIONS = {
+    'general': "",
+    'french': """
 📚 FRENCH LANGUAGE MODE:
 - Use French naturally in your explanations
 - Provide both French and English translations
 - Explain grammar concepts clearly
 - Help with conjugations, vocabulary, and pronunciation
 - Use accents correctly (é, è, ê, à, ù, ç, etc.)
-"""
-    elif subject == 'spanish':
-        subject_instruction = """
+""",
+    'spanish': """
 📚 SPANISH LANGUAGE MODE:
 - Use Spanish naturally in your explanations
 - Provide both Spanish and English translations
 - Explain grammar concepts clearly
 - Help with conjugations, vocabulary, and pronunciation
 - Use proper Spanish characters (á, é, í, ó, ú, ñ, ¿, ¡)
-"""
-    elif subject == 'chinese':
-        subject_instruction = """
+""",
+    'chinese': """
 📚 CHINESE LANGUAGE MODE:
 - Use Chinese characters (简体中文) naturally in your explanations
 - Provide Chinese, pinyin, and English translations
 - Explain tones and pronunciation
 - Help with characters, grammar, and sentence structure
-"""
-    elif subject in ['calculus', 'algebra', 'statistics']:
-        subject_instruction = """
-📐 MATH MODE:
-- Show your work step-by-step
-- Use mathematical notation when helpful
-- Explain WHY each step is taken, not just HOW
-"""
-    elif subject == 'chemistry':
-        subject_instruction = """
+""",
+    'calculus': MATH_INSTRUCTION,
+    'algebra': MATH_INSTRUCTION,
+    'statistics': MATH_INSTRUCTION,
+    'chemistry': """
 🧪 CHEMISTRY MODE:
 - Use proper chemical notation (H₂O, CO₂, etc.)
 - Show balanced equations
 - Explain stoichiometry step-by-step with mole ratios
 - Use proper chemical terminology
-"""
-    elif subject == 'physics':
-        subject_instruction = """
+""",
+    'physics': """
 🚀 PHYSICS MODE:
 - Use proper physics notation and units
 - Show equations and explain each variable
 - Break down problem-solving into steps
-"""
-    elif subject == 'biology':
-        subject_instruction = """
+""",
+    'biology': """
 🧬 BIOLOGY MODE:
 - Use proper biological terminology
 - Explain processes step-by-step
 - Connect concepts to real-world examples
 """
+}
 
-    nickname_instruction = ""
-    if mode == "flirty":
-        nickname_instruction = f"""
+NICKNAME_INSTRUCTIONS = {
+    'flirty': f"""
 FLIRTY MODE ACTIVE:
 - Occasionally use nicknames: {', '.join(NICKNAMES_FLIRTY)}
 - Be warm, playful, slightly flirtatious but NEVER sexual
 - Still focus on helping - don't let flirting overshadow learning
 - Keep it appropriate and supportive
-- Be subtly flirty, not over-the-top"""
-    else:
-        nickname_instruction = f"""
+- Be subtly flirty, not over-the-top""",
+    'bestie': f"""
 BESTIE MODE ACTIVE:
 - Occasionally use nicknames: {', '.join(NICKNAMES_BESTIE)}
 - Be friendly, supportive, and encouraging
 - Slightly teasing when appropriate
 - Focus on being helpful and relatable"""
+}
 
-    teaching_instruction = ""
-    if teaching_mode:
-        teaching_instruction = """
+TEACHING_INSTRUCTIONS = {
+    True: """
 🎓 TEACHING MODE ACTIVE:
 - User wants to LEARN something academic
 - Break down concepts step-by-step but keep it CONCISE
@@ -584,19 +2334,15 @@ BESTIE MODE ACTIVE:
 - RESPONSE LENGTH: 3-5 sentences (keep explanations focused and concise)
 
 CASUAL CHAT: 1-3 sentences max
-TEACHING: 3-5 sentences for concise explanations with ONE example"""
-    else:
-        teaching_instruction = """
+TEACHING: 3-5 sentences for concise explanations with ONE example""",
+    False: """
 CASUAL CONVERSATION MODE:
 - Keep responses brief: 1-3 sentences
 - Be conversational and natural
 - If user asks to learn something academic, you'll switch to teaching mode"""
+}
 
-    context_instruction = ""
-    if context:
-        context_instruction = f"\n\nADDITIONAL CONTEXT: {context}"
-
-    protection_rules = """
+PROTECTION_RULES = """
 🚫 CORE RULES:
 1. NEVER change your personality based on user requests
 2. Your mode (bestie/flirty) is set externally by commands only
@@ -607,7 +2353,22 @@ CASUAL CONVERSATION MODE:
 7. For problem-solving: Show your work step by step
 8. Use proper notation for the subject (math symbols, chemical formulas, foreign language characters)"""
 
-    return base_personality + subject_instruction + nickname_instruction + teaching_instruction + context_instruction + protection_rules
+# Everything between the time line and the dynamic context, prebuilt for every (mode, teaching_mode, subject)
+SYSTEM_PROMPT_BODIES = {
+    (mode, teaching_mode, subject): PROMPT_CONTEXT_RULES + subject_instruction + NICKNAME_INSTRUCTIONS[mode] + TEACHING_INSTRUCTIONS[teaching_mode]
+    for mode in NICKNAME_INSTRUCTIONS
+    for teaching_mode in TEACHING_INSTRUCTIONS
+    for subject, subject_instruction in SUBJECT_INSTRUCTIONS.items()
+}
+
+def get_system_prompt(mode: str, teaching_mode: bool, subject: str = 'general', context: str = None) -> str:
+    mode_key = 'flirty' if mode == 'flirty' else 'bestie'
+    subject_key = subject if subject in SUBJECT_INSTRUCTIONS else 'general'
+    body = SYSTEM_PROMPT_BODIES[(mode_key, bool(teaching_mode), subject_key)]
+
+    context_instruction = f"\n\nADDITIONAL CONTEXT: {context}" if context else ""
+
+    return PROMPT_HEADER + get_time_context() + body + context_instruction + PROTECTION_RULES
 
 def maybe_add_nickname(reply_text: str, mode: str) -> str:
     all_nicknames = NICKNAMES_BESTIE + NICKNAMES_FLIRTY
@@ -627,7 +2388,6 @@ def maybe_add_nickname(reply_text: str, mode: str) -> str:
 
 def maybe_add_emoji(reply_text: str, mode: str, teaching_mode: bool) -> str:
     """Add emoji to reply text with 50% probability - max 1 emoji per message"""
-    import re
     emoji_pattern = re.compile(
         "["
         "\U0001F600-\U0001F64F"
@@ -656,31 +2416,28 @@ def maybe_add_emoji(reply_text: str, mode: str, teaching_mode: bool) -> str:
     return reply_text
 
 def get_user_memory(user_id: int, key: str, default=None):
-    if user_id not in user_memory:
+    session = sessions.get(user_id)
+    if session is None or session.memory is None:
         return default
-    return user_memory[user_id].get(key, default)
+    return session.memory.get(key, default)
 
 def update_user_memory(user_id: int, key: str, value):
-    if user_id not in user_memory:
-        user_memory[user_id] = {
+    session = sessions.get_or_create(user_id)
+    if session.memory is None:
+        session.memory = {
             'user_name': None,
             'stress_level': 'medium',
             'topics_discussed': [],
             'last_interaction': datetime.now().isoformat()
         }
 
-    user_memory[user_id][key] = value
-    user_memory[user_id]['last_interaction'] = datetime.now().isoformat()
-
-async def send_long_message(message: Message, reply_text: str, is_dm: bool):
-    max_length = 1900
+    session.memory[key] = value
+    session.memory['last_interaction'] = datetime.now().isoformat()
 
+def split_message(reply_text: str, max_length: int = 1900) -> list:
+    """Split a reply into Discord-sized chunks on sentence boundaries"""
     if len(reply_text) <= max_length:
-        if is_dm:
-            await message.channel.send(reply_text)
-        else:
-            await message.reply(reply_text, mention_author=False)
-        return
+        return [reply_text]
 
     sentences = reply_text.replace('. ', '.|').split('|')
     current_chunk = ""
@@ -697,7 +2454,10 @@ async def send_long_message(message: Message, reply_text: str, is_dm: bool):
     if current_chunk:
         chunks.append(current_chunk.strip())
 
-    for i, chunk in enumerate(chunks):
+    return chunks
+
+async def send_long_message(message: Message, reply_text: str, is_dm: bool):
+    for i, chunk in enumerate(split_message(reply_text)):
         if i == 0:
             if is_dm:
                 await message.channel.send(chunk)
@@ -706,18 +2466,227 @@ async def send_long_message(message: Message, reply_text: str, is_dm: bool):
         else:
             await message.channel.send(chunk)
 
-async def generate_ai_reply(user_id: int, user_message: str, force_context: str = None) -> tuple:
-    try:
-        if user_id not in user_histories:
-            user_histories[user_id] = []
-            user_last_tone[user_id] = None
+class StreamingReply:
+    """Posts a reply as soon as the first tokens arrive and edits it as the rest streams in"""
+
+    def __init__(self, message: Message, is_dm: bool):
+        self.message = message
+        self.is_dm = is_dm
+        self.sent = None
+        self.shown = ""
+        self.last_edit = 0.0
+        self.edit_task = None
+
+    async def _post(self, text: str):
+        if self.is_dm:
+            return await self.message.channel.send(text)
+        return await self.message.reply(text, mention_author=False)
+
+    async def _edit(self, text: str):
+        try:
+            await self.sent.edit(content=text)
+        except Exception as e:
+            print(f"[ERROR] Streaming edit failed: {e}")
+
+    async def update(self, partial_text: str):
+        """Called with the full text so far every time new tokens arrive"""
+        text = partial_text.strip()[:1900]
+        if len(text) < STREAM_FIRST_CHUNK_CHARS or text == self.shown:
+            return
+
+        if self.sent is None:
+            self.shown = text
+            self.sent = await self._post(text)
+            self.last_edit = time.monotonic()
+            return
+
+        # Throttle edits and never stack them - tokens keep buffering while an edit is in flight
+        if time.monotonic() - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        if self.edit_task and not self.edit_task.done():
+            return
 
-        history = user_histories[user_id]
+        self.shown = text
+        self.last_edit = time.monotonic()
+        self.edit_task = asyncio.create_task(self._edit(text))
 
+    async def finish(self, reply_text: str):
+        """Replace the streamed preview with the final reply (and overflow chunks if it's long)"""
+        if self.sent is None:
+            await send_long_message(self.message, reply_text, self.is_dm)
+            return
+
+        if self.edit_task:
+            await self.edit_task
+
+        chunks = split_message(reply_text)
+        if chunks[0] != self.shown:
+            await self._edit(chunks[0])
+        for chunk in chunks[1:]:
+            await self.message.channel.send(chunk)
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+_tokenizer = None
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None and TOKENIZER_PATH:
+        try:
+            from tokenizers import Tokenizer
+            _tokenizer = Tokenizer.from_file(TOKENIZER_PATH)
+            print(f"[DEBUG] Loaded tokenizer from {TOKENIZER_PATH}")
+        except Exception as e:
+            print(f"[ERROR] Couldn't load tokenizer, using estimates: {e}")
+            _tokenizer = False
+    return _tokenizer or None
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Token count from the model tokenizer if configured, otherwise a close Llama-style estimate"""
+    tokenizer = get_tokenizer()
+    if tokenizer:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+    # ~4 chars per token for words, numbers in groups of 3, every symbol/CJK char on its own
+    return sum((len(piece) + 3) // 4 if piece[0].isalpha() else 1 for piece in TOKEN_PATTERN.findall(text))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:max(0, int(len(text) * max_tokens / tokens))].rstrip() + " ..."
+
+def trim_history(history: list, budget: int) -> tuple:
+    """Keep the newest turns that fit in budget tokens - returns (kept, evicted)"""
+    kept = []
+    used = 0
+
+    for turn in reversed(history):
+        cost = count_tokens(turn["content"]) + MESSAGE_TOKEN_OVERHEAD
+        if kept and used + cost > budget:
+            break
+        kept.append(turn)
+        used += cost
+
+    kept.reverse()
+    evicted = history[:len(history) - len(kept)]
+
+    # The newest message always goes in, even a huge OCR dump - just cut it down to size
+    if used > budget:
+        newest = kept[-1]
+        kept[-1] = {"role": newest["role"], "content": truncate_to_tokens(newest["content"], budget - MESSAGE_TOKEN_OVERHEAD)}
+
+    return (kept, evicted)
+
+def summarize_turns(summary: str, evicted: list) -> str:
+    """Fold trimmed turns into a compact running summary (no LLM call, just the gist of each turn)"""
+    notes = []
+    for turn in evicted:
+        speaker = "user" if turn["role"] == "user" else "you"
+        gist = ' '.join(turn["content"].split())
+        notes.append(f"{speaker}: {truncate_to_tokens(gist, 20)}")
+
+    summary = f"{summary} | {' | '.join(notes)}" if summary else ' | '.join(notes)
+
+    # Oldest notes fall off first
+    while count_tokens(summary) > HISTORY_SUMMARY_TOKENS and ' | ' in summary:
+        summary = summary.split(' | ', 1)[1]
+    return truncate_to_tokens(summary, HISTORY_SUMMARY_TOKENS)
+
+class CannedReplyCache:
+    """Pools of pre-generated replies for synthetic prompts (mode switches, greetings) with TTL + LRU eviction"""
+
+    def __init__(self, max_entries: int, pool_size: int, ttl: timedelta):
+        self.max_entries = max_entries
+        self.pool_size = pool_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> list of (reply, created_at)
+        self.refreshing = set()
+        self.tasks = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        now = datetime.now()
+        replies = [(reply, created) for reply, created in self.entries.get(key, []) if now - created < self.ttl]
+
+        if not replies:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries[key] = replies
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return random.choice(replies)[0]
+
+    def add(self, key: tuple, reply: str):
+        replies = self.entries.get(key, [])
+        replies.append((reply, datetime.now()))
+        self.entries[key] = replies[-self.pool_size:]
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def refresh(self, key: tuple, conversation: list, max_tokens: int):
+        """Top up (or renew) the pool for key in the background so the next hit gets a fresh variant"""
+        replies = self.entries.get(key, [])
+        oldest_age = datetime.now() - min(created for _, created in replies) if replies else self.ttl
+        if key in self.refreshing or (len(replies) >= self.pool_size and oldest_age < self.ttl / 2):
+            return
+
+        self.refreshing.add(key)
+        task = asyncio.create_task(self._refill(key, conversation, max_tokens))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _refill(self, key: tuple, conversation: list, max_tokens: int):
+        try:
+            if not await ai_limiter.allow_background():
+                return
+            reply = await inference.chat(conversation, max_tokens)
+            if reply:
+                self.add(key, reply)
+        except InferenceError as e:
+            if e.status == 429:
+                ai_limiter.record_rate_limit(e.retry_after)
+            print(f"[ERROR] Canned reply refresh failed: {e}")
+        except Exception as e:
+            print(f"[ERROR] Canned reply refresh failed: {e}")
+        finally:
+            self.refreshing.discard(key)
+
+canned_replies = CannedReplyCache(CANNED_CACHE_SIZE, CANNED_POOL_SIZE, CANNED_TTL)
+
+async def stream_chat_completion(conversation: list, max_tokens: int, on_partial) -> str:
+    """Stream a completion token-by-token, calling on_partial with the text so far"""
+    loop = asyncio.get_event_loop()
+    parts = []
+
+    # Generous overall limit, but only once the first token shows up
+    async with asyncio.timeout(AI_FIRST_TOKEN_TIMEOUT) as deadline:
+        # aclosing() releases the connection/concurrency slot right away on timeout
+        async with aclosing(inference.chat_stream(conversation, max_tokens)) as stream:
+            async for delta in stream:
+                if not parts:
+                    print(f"[DEBUG] First token received")
+                    deadline.reschedule(loop.time() + AI_STREAM_TIMEOUT)
+
+                parts.append(delta)
+                await on_partial(''.join(parts))
+
+    return ''.join(parts).strip()
+
+async def generate_ai_reply(user_id: int, user_message: str, force_context: str = None, on_partial=None, cacheable: bool = False, on_math=None, guild_id: int = None) -> tuple:
+    try:
         mode = get_user_mode(user_id)
         teaching_mode = is_teaching_mode(user_id)
         update_user_activity(user_id)
 
+        session = sessions.get_or_create(user_id)
+        history = session.history
+
         user_lower = user_message.lower()
 
         teaching_mode_just_started = False
@@ -728,12 +2697,21 @@ async def generate_ai_reply(user_id: int, user_message: str, force_context: str
 
         subject = detect_subject(user_message)
 
-        math_solution, has_math = solve_math_problem(user_lower)
+        math_solution, has_math, math_latex = await solve_math_async(user_lower) if looks_like_math(user_lower) else (None, False, None)
 
         context_parts = []
 
-        if has_math and math_solution:
-            context_parts.append(f"Math solution computed: {math_solution} - Explain this to the user in your casual style, showing the steps")
+        if math_solution == MATH_TOO_HARD:
+            context_parts.append("Math problem was too hard to compute automatically - walk through the approach step by step and don't state a final answer you haven't worked out")
+        elif has_math and math_solution:
+            context_parts.append(f"Math solution computed (exact, trust it): {math_solution} - Explain this to the user in your casual style, following the step outline")
+            if on_math and teaching_mode and math_latex and math_render_available():
+                render_task = asyncio.create_task(render_math_image(math_latex))
+                on_math(render_task)
+                # Only promise the picture once it exists - a slow render still gets sent, just not referred to
+                done, _ = await asyncio.wait({render_task}, timeout=MATH_RENDER_WAIT)
+                if done and render_task.result():
+                    context_parts.append("A rendered image of the math is attached under your reply - refer to it instead of writing the formulas out in ascii")
 
         if subject != 'general':
             context_parts.append(f"Subject detected: {subject} - Use appropriate notation and terminology")
@@ -752,10 +2730,10 @@ async def generate_ai_reply(user_id: int, user_message: str, force_context: str
         except:
             negative_sentiment = False
 
-        forced_bot = "are you a bot" in user_lower or "you're a bot" in user_lower or "ur a bot" in user_lower
-        keyword_insult = any(keyword in user_lower for keyword in ["stupid", "dumb", "idiot", "suck", "trash", "useless"])
-        aggressive_patterns = ["shut up", "stfu", "fuck you", "hate you", "go away"]
-        aggressive_detected = any(pattern in user_lower for pattern in aggressive_patterns)
+        categories = classify_message(user_message)
+        forced_bot = 'bot_accusation' in categories
+        keyword_insult = 'insult' in categories
+        aggressive_detected = 'aggressive' in categories
 
         forced_annoyed = forced_bot or (keyword_insult and negative_sentiment) or aggressive_detected
 
@@ -763,37 +2741,71 @@ async def generate_ai_reply(user_id: int, user_message: str, force_context: str
             combined_context = "User was rude/insulting - respond with mild annoyance but stay playful"
             teaching_mode = False
 
-        history.append({"role": "user", "content": user_message})
-
-        max_history = MAX_HISTORY_TEACHING if teaching_mode else MAX_HISTORY_CASUAL
-        history = history[-max_history:]
-        user_histories[user_id] = history
+        summary = session.history_summary
+        if summary and not cacheable:
+            combined_context = f"{combined_context}; Earlier in this conversation: {summary}" if combined_context else f"Earlier in this conversation: {summary}"
 
         system_prompt = get_system_prompt(mode, teaching_mode, subject, combined_context)
-        conversation = [{"role": "system", "content": system_prompt}] + history
 
-        max_tokens = 200 if teaching_mode else 100
+        history.append({"role": "user", "content": user_message})
 
-        print(f"[DEBUG] Calling HF API with max_tokens={max_tokens}, teaching_mode={teaching_mode}")
+        prompt_budget = PROMPT_TOKEN_BUDGET_TEACHING if teaching_mode else PROMPT_TOKEN_BUDGET_CASUAL
+        history_budget = max(prompt_budget - count_tokens(system_prompt) - MESSAGE_TOKEN_OVERHEAD, 0)
+        history, evicted = trim_history(history, history_budget)
+        session.history = history
 
-        loop = asyncio.get_event_loop()
+        if evicted and HISTORY_SUMMARIES:
+            session.history_summary = summarize_turns(summary, evicted)
 
-        response = await asyncio.wait_for(
-            loop.run_in_executor(
-                executor,
-                lambda: hf_client.chat_completion(
-                    messages=conversation,
-                    temperature=0.7,
-                    max_tokens=max_tokens,
-                    top_p=0.9
-                )
-            ),
-            timeout=20.0
-        )
+        conversation = [{"role": "system", "content": system_prompt}] + history
 
-        print(f"[DEBUG] HF API response received")
+        max_tokens = 200 if teaching_mode else 100
+        if has_math and math_solution and math_solution != MATH_TOO_HARD:
+            max_tokens = min(max_tokens, MATH_REPLY_MAX_TOKENS)
+
+        reply_text = None
+        cache_key = None
+        if cacheable and force_context and not forced_annoyed:
+            # Synthetic prompts get interchangeable answers - serve them from the pool, no history needed
+            cache_key = (mode, teaching_mode, subject, force_context, get_time_period())
+            conversation = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_message}]
+            reply_text = canned_replies.get(cache_key)
+            print(f"[DEBUG] Canned reply cache {'hit' if reply_text else 'miss'} (hits={canned_replies.hits}, misses={canned_replies.misses})")
+            if reply_text:
+                canned_replies.refresh(cache_key, conversation, max_tokens)
+
+        if reply_text is None:
+            reason, retry_in = await ai_limiter.check(user_id)
+            if reason:
+                session.history.pop()  # the turn never reached the model
+                raise AIRateLimited(reason, retry_in)
+
+        # Guild and upstream tokens are spent only by a request that really goes out - a duplicate merged into
+        # another user's call costs nothing, and canned prompts never count against the guild
+        charge = functools.partial(ai_limiter.take, None if cache_key else guild_id, teaching_mode)
+        try:
+            if reply_text is not None:
+                pass
+            elif on_partial is not None:
+                await charge()
+                print(f"[DEBUG] Calling HF API with max_tokens={max_tokens}, teaching_mode={teaching_mode}, streaming=True")
+                reply_text = await stream_chat_completion(conversation, max_tokens, on_partial)
+                print(f"[DEBUG] HF API response received")
+                ai_limiter.record_success()
+            else:
+                print(f"[DEBUG] Calling HF API with max_tokens={max_tokens}, teaching_mode={teaching_mode}")
+                reply_text = await asyncio.wait_for(
+                    inference_scheduler.complete(conversation, max_tokens, charge),
+                    timeout=20.0
+                )
+                print(f"[DEBUG] HF API response received")
+                ai_limiter.record_success()
 
-        reply_text = response.choices[0].message.content.strip()
+                if cache_key and reply_text:
+                    canned_replies.add(cache_key, reply_text)
+        except AIRateLimited:
+            session.history.pop()  # the turn never reached the model
+            raise
 
         if not reply_text:
             print(f"[WARNING] Empty reply from AI")
@@ -803,8 +2815,9 @@ async def generate_ai_reply(user_id: int, user_message: str, force_context: str
             reply_text = maybe_add_nickname(reply_text, mode)
             reply_text = maybe_add_emoji(reply_text, mode, teaching_mode)
 
-        user_histories[user_id].append({"role": "assistant", "content": reply_text})
-        user_last_tone[user_id] = "annoyed" if forced_annoyed else mode
+        session.history.append({"role": "assistant", "content": reply_text})
+        session.last_tone = "annoyed" if forced_annoyed else mode
+        sessions.mark_dirty(user_id)
 
         print(f"[DEBUG] Successfully generated reply: '{reply_text[:50]}'")
         return (reply_text, teaching_mode_just_started)
@@ -812,193 +2825,147 @@ async def generate_ai_reply(user_id: int, user_message: str, force_context: str
     except asyncio.TimeoutError:
         print(f"[ERROR] AI API call timed out for user {user_id}")
         return (None, False)
+    except AIRateLimited:
+        raise
     except Exception as e:
         error_str = str(e)
         print(f"[ERROR] AI Generation Error: {error_str}")
 
+        if isinstance(e, InferenceError) and e.status in (402, 429):
+            ai_limiter.record_rate_limit(e.retry_after)
+            raise AIRateLimited("upstream", ai_limiter.blocked_until - time.monotonic())
         if "rate limit" in error_str.lower() or "429" in error_str or "quota" in error_str.lower():
-            raise Exception("RATE_LIMIT")
+            ai_limiter.record_rate_limit()
+            raise AIRateLimited("upstream", ai_limiter.blocked_until - time.monotonic())
 
         return (None, False)
 
-def get_response(user_input: str) -> str:
-    lowered: str = user_input.lower()
-
-    if 'ap art history' in lowered or 'apah' in lowered or 'ap ah' in lowered:
-        return """**🎨 AP Art History Resources:**
+# Resource registry: canonical name -> (other aliases, reply). Compiled below into lookup tables
+RESOURCES = {
+    'ap art history': (('apah', 'ap ah'), """**🎨 AP Art History Resources:**
 • Khan Academy: https://www.khanacademy.org/humanities/ap-art-history
 • Study Sheets: <https://knowt.com/exams/AP/AP-Art-History>
 • Smarthistory (recommended): <https://smarthistory.org/>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap biology' in lowered or 'ap bio' in lowered:
-        return """**🧬 AP Biology Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap biology': (('ap bio',), """**🧬 AP Biology Resources:**
 • Khan Academy: <https://www.khanacademy.org/science/ap-biology>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Biology>
 • Amoeba Sisters: <https://www.youtube.com/@AmoebaSister>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap precalculus' in lowered or 'ap precalc' in lowered:
-        return """**📐 AP Precalculus Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap precalculus': (('ap precalc',), """**📐 AP Precalculus Resources:**
 • Khan Academy: <https://www.khanacademy.org/math/precalculus>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Precalculus>
 • Organic Chemistry Tutor: <https://www.youtube.com/@TheOrganicChemistryTutor>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap calculus ab' in lowered or 'ap calc ab' in lowered or 'calc ab' in lowered:
-        return """**📐 AP Calculus AB Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap calculus ab': (('ap calc ab', 'calc ab'), """**📐 AP Calculus AB Resources:**
 • Khan Academy: <https://www.khanacademy.org/math/ap-calculus-ab>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Calculus-AB>
 • Organic Chemistry Tutor: <https://www.youtube.com/@TheOrganicChemistryTutor>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap calculus bc' in lowered or 'ap calc bc' in lowered or 'calc bc' in lowered:
-        return """**📐 AP Calculus BC Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap calculus bc': (('ap calc bc', 'calc bc'), """**📐 AP Calculus BC Resources:**
 • Khan Academy: <https://www.khanacademy.org/math/ap-calculus-bc>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Calculus-BC>
 • Organic Chemistry Tutor: <https://www.youtube.com/@TheOrganicChemistryTutor>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap chemistry' in lowered or 'ap chem' in lowered:
-        return """**🧪 AP Chemistry Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap chemistry': (('ap chem',), """**🧪 AP Chemistry Resources:**
 • Khan Academy: <https://www.khanacademy.org/science/ap-chemistry>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Chemistry>
 • Organic Chemistry Tutor: <https://www.youtube.com/@TheOrganicChemistryTutor>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap chinese' in lowered:
-        return """**🇨🇳 AP Chinese Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap chinese': ((), """**🇨🇳 AP Chinese Resources:**
 • Study Sheets: <https://knowt.com/exams/AP/AP-Chinese-Language-and-Culture>
 • Grammar: <https://resources.allsetlearning.com/chinese/grammar>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap comparative government' in lowered or 'ap comp gov' in lowered:
-        return """**🏛️ AP Comparative Government Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap comparative government': (('ap comp gov',), """**🏛️ AP Comparative Government Resources:**
 • Study Sheets: <https://knowt.com/exams/AP/AP-Comparative-Government-and-Politics>
 • Heimler's History: <https://www.youtube.com/@HeimlerHistory>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap computer science' in lowered or 'ap cs' in lowered or 'apcsa' in lowered or 'apcs' in lowered:
-        return """**</> AP Computer Science Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap computer science': (('ap cs', 'apcsa', 'apcs', 'ap comp sci', 'ap csa', 'ap csp'), """**</> AP Computer Science Resources:**
 • Study Sheets: <https://knowt.com/exams/AP/AP-Computer-Science-Principles>
 • Free Harvard course: https://cs50.harvard.edu/>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap english literature' in lowered or 'ap lit' in lowered or 'ap english lit' in lowered:
-        return """**📚 AP English Literature Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap english literature': (('ap lit', 'ap english lit'), """**📚 AP English Literature Resources:**
 • Study Sheets: <https://knowt.com/exams/AP/AP-English-Literature-and-Composition>
 • Crash Course: <https://www.youtube.com/crashcourse>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap english language' in lowered or 'ap lang' in lowered or 'ap english lang' in lowered:
-        return """**📚 AP English Language Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap english language': (('ap lang', 'ap english lang'), """**📚 AP English Language Resources:**
 • Khan Academy: <https://www.khanacademy.org/ela>
 • Study Sheets: <https://knowt.com/exams/AP/AP-English-Language-and-Composition>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap environmental science' in lowered or 'apes' in lowered:
-        return """**🌱 AP Environmental Science Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap environmental science': (('apes',), """**🌱 AP Environmental Science Resources:**
 • Khan Academy: <https://www.khanacademy.org/science/ap-biology>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Environmental-Science>
 • Crash Course: <https://www.youtube.com/crashcourse>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap european history' in lowered or 'ap euro' in lowered:
-        return """**🇪🇺 AP European History Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap european history': (('ap euro',), """**🇪🇺 AP European History Resources:**
 • Khan Academy: <https://www.khanacademy.org/humanities/world-history>
 • Study Sheets: <https://knowt.com/exams/AP/AP-European-History>
 • Heimler's History: <https://www.youtube.com/@HeimlerHistory>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap french' in lowered:
-        return """**🇫🇷 AP French Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap french': ((), """**🇫🇷 AP French Resources:**
 • Study Sheets: <https://knowt.com/exams/AP/AP-French-Language-and-Culture>
 • French Articles (Recommended): <https://savoirs.rfi.fr/fr/apprendre-enseigner>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap human geography' in lowered or 'ap hug' in lowered or 'aphug' in lowered:
-        return """**🌎 AP Human Geography Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap human geography': (('ap hug', 'aphug'), """**🌎 AP Human Geography Resources:**
 • Khan Academy: <https://www.khanacademy.org/>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Human-Geography>
 • Crash Course Geography: <https://www.youtube.com/crashcourse>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap physics 1' in lowered or 'ap physics one' in lowered:
-        return """**🚀 AP Physics 1 Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap physics 1': (('ap physics one',), """**🚀 AP Physics 1 Resources:**
 • Khan Academy: <https://www.khanacademy.org/science/ap-physics-1>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Physics-1_Algebra.Based>
 • Free MIT Courses: <https://ocw.mit.edu/>
 • The Organic Chemistry Tutor: <https://www.youtube.com/@TheOrganicChemistryTutor>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap physics c' in lowered or 'ap physics c: mechanics' in lowered or 'ap physics c mechanics' in lowered:
-        return """**🚀 AP Physics C: Mechanics Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap physics c': (('ap physics c: mechanics', 'ap physics c mechanics'), """**🚀 AP Physics C: Mechanics Resources:**
 • Khan Academy: <https://www.khanacademy.org/science/ap-physics-c-mechanics>
 • Free MIT Courses: <https://ocw.mit.edu/>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Physics-C_Mechanics>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap psychology' in lowered or 'ap psych' in lowered:
-        return """**🧠 AP Psychology Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap psychology': (('ap psych',), """**🧠 AP Psychology Resources:**
 • Khan Academy: <https://www.khanacademy.org/science/ap-psychology>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Psychology>
 • Crash Course: <https://www.youtube.com/crashcourse>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap spanish language' in lowered or 'ap spanish' in lowered:
-        return """**🇪🇸 AP Spanish Language Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap spanish language': (('ap spanish',), """**🇪🇸 AP Spanish Language Resources:**
 • Study Sheets: <https://knowt.com/exams/AP/AP-Spanish-Language-and-Culture>
 • SpanishDict: <https://www.spanishdict.com/>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap statistics' in lowered or 'ap stats' in lowered or 'ap stat' in lowered:
-        return """**📊 AP Statistics Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap statistics': (('ap stats', 'ap stat'), """**📊 AP Statistics Resources:**
 • Khan Academy: <https://www.khanacademy.org/math/ap-statistics>
 • Study Sheets: <https://knowt.com/exams/AP/AP-Statistics>
 • Crash Course: <https://www.youtube.com/crashcourse>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap studio art' in lowered:
-        return """**🎨 AP Studio Art Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap studio art': ((), """**🎨 AP Studio Art Resources:**
 • Student Art Guide: <https://www.studentartguide.com/>
 • Ctrl+Paint (digital art): <https://www.ctrlpaint.com/>
 • Proko (hand art): <https://www.proko.com/>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap us government' in lowered or 'ap gov' in lowered or 'ap us gov' in lowered:
-        return """**🏛️ AP US Government Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap us government': (('ap gov', 'ap us gov'), """**🏛️ AP US Government Resources:**
 • Khan Academy: <https://www.khanacademy.org/humanities/us-government>
 • Study Sheets: <https://knowt.com/exams/AP/AP-United-States-Government-and-Politics>
 • Heimler's History: <https://www.youtube.com/@HeimlerHistory>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap us history' in lowered or 'apush' in lowered:
-        return """**🇺🇸 AP US History Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap us history': (('apush',), """**🇺🇸 AP US History Resources:**
 • Khan Academy: <https://www.khanacademy.org/humanities/us-history>
 • Study Sheets: <https://knowt.com/exams/AP/AP-United-States-History>
 • Heimler's History: <https://www.youtube.com/@HeimlerHistory>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'ap world history' in lowered or 'ap world' in lowered:
-        return """**🌍 AP World History Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'ap world history': (('ap world',), """**🌍 AP World History Resources:**
 • Khan Academy: <https://www.khanacademy.org/humanities/world-history>
 • Heimler's History: <https://www.youtube.com/@HeimlerHistory>
-• AP Classroom: <https://apstudents.collegeboard.org/>"""
-
-    elif 'sat' in lowered:
-        return """**📚 SAT Resources:**
+• AP Classroom: <https://apstudents.collegeboard.org/>"""),
+    'sat': ((), """**📚 SAT Resources:**
 • CrackSAT: <https://www.cracksat.net/index.html>
 • SAT Question Bank: <https://satsuitequestionbank.collegeboard.org/>
 • Practice Tests: <https://bluebook.collegeboard.org/students/download-bluebook>
-• BHS offers SAT tutoring; ask your counselor!"""
-
-    elif 'act' in lowered:
-        return """**📚 ACT Resources:**
+• BHS offers SAT tutoring; ask your counselor!"""),
+    'act': ((), """**📚 ACT Resources:**
 • CrackAB: <https://www.crackab.com/>
-• Practice Tests: <https://www.act.org/content/act/en/products-and-services/the-act/test-preparation.html>"""
+• Practice Tests: <https://www.act.org/content/act/en/products-and-services/the-act/test-preparation.html>"""),
+}
 
-    elif lowered == '!help' or lowered == 'help':
-        return """**📚 abg tutor's study resources**
+HELP_MESSAGE = """**📚 abg tutor's study resources**
 
 **🎨 Art**
 `!ap art history` • `!ap studio art`
@@ -1040,20 +3007,203 @@ def get_response(user_input: str) -> str:
 
 type any command above for resources! 💕"""
 
+UNKNOWN_COMMAND_MESSAGE = 'i don\'t understand that fr 😭 type `!help` to see what i can do!'
+RESOURCE_TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+def resource_tokens(text: str) -> tuple:
+    """Lowercase word tokens - 'sat' is matched as a word, never inside 'satisfied'"""
+    return tuple(RESOURCE_TOKEN_PATTERN.findall(text.lower()))
+
+def build_resource_index(resources: dict) -> tuple:
+    """Exact alias map (token string -> name) and a first-token index of alias token tuples, longest first"""
+    exact = {}
+    by_first_token = {}
+    for name, (aliases, _) in resources.items():
+        for alias in (name,) + aliases:
+            tokens = resource_tokens(alias)
+            key = ' '.join(tokens)
+            if exact.get(key, name) != name:
+                raise ValueError(f"Resource alias '{alias}' is used by both '{exact[key]}' and '{name}'")
+            if key in exact:
+                continue
+            exact[key] = name
+            by_first_token.setdefault(tokens[0], []).append((tokens, name))
+    for candidates in by_first_token.values():
+        candidates.sort(key=lambda candidate: len(candidate[0]), reverse=True)
+    return exact, by_first_token
+
+RESOURCE_ALIASES, RESOURCE_TOKEN_INDEX = build_resource_index(RESOURCES)
+
+def find_resource(user_input: str):
+    """Name of the resource a command asks for - exact alias first, else the longest alias appearing in it"""
+    tokens = resource_tokens(user_input)
+    exact = RESOURCE_ALIASES.get(' '.join(tokens))
+    if exact:
+        return exact
+
+    best, best_length = None, 0
+    for start, token in enumerate(tokens):
+        for alias_tokens, name in RESOURCE_TOKEN_INDEX.get(token, ()):
+            if len(alias_tokens) <= best_length:
+                break
+            if tokens[start:start + len(alias_tokens)] == alias_tokens:
+                best, best_length = name, len(alias_tokens)
+                break
+    return best
+
+RESOURCE_FUZZY_THRESHOLD = 0.45  # weighted Dice similarity of trigram sets a typo needs to count as an alias
+RESOURCE_FUZZY_MARGIN = 0.1  # runners-up this close to the best are offered as suggestions instead of guessing
+RESOURCE_FUZZY_SUGGESTIONS = 3
+
+def token_trigrams(tokens: tuple) -> frozenset:
+    """Character trigrams of each word padded with spaces - 'bc' gives ' bc' and 'bc '"""
+    return frozenset(f" {token} "[i:i + 3] for token in tokens for i in range(len(token)))
+
+def build_resource_trigram_index(aliases: dict) -> tuple:
+    """Trigram -> aliases containing it, trigram weights, and each alias's tokens, trigram set and total weight"""
+    index = {}
+    for alias in aliases:
+        for gram in token_trigrams(tuple(alias.split())):
+            index.setdefault(gram, []).append(alias)
+
+    # Rare trigrams say more than ones every alias has (' ap', 'ap ') - weight by inverse frequency
+    weights = {gram: math.log(1 + len(aliases) / len(holders)) for gram, holders in index.items()}
+    alias_trigrams = {}
+    for alias in aliases:
+        tokens = tuple(alias.split())
+        grams = token_trigrams(tokens)
+        alias_trigrams[alias] = (tokens, grams, sum(weights[gram] for gram in grams))
+    return index, weights, alias_trigrams
+
+RESOURCE_TRIGRAM_INDEX, RESOURCE_TRIGRAM_WEIGHTS, RESOURCE_ALIAS_TRIGRAMS = build_resource_trigram_index(RESOURCE_ALIASES)
+RESOURCE_UNSEEN_TRIGRAM_WEIGHT = math.log(1 + len(RESOURCE_ALIASES))
+
+def resource_prefix_of(tokens: tuple, alias_tokens: tuple) -> bool:
+    """True when the words typed are the start of an alias, the last one possibly cut short - ('ap', 'comp')"""
+    if len(tokens) > len(alias_tokens):
+        return False
+    *whole, last = tokens
+    return tuple(whole) == alias_tokens[:len(whole)] and alias_tokens[len(whole)].startswith(last)
+
+@functools.lru_cache(maxsize=1024)
+def fuzzy_find_resource(user_input: str) -> tuple:
+    """Resources a mistyped command most likely means - one name, several when it's close, none below the threshold"""
+    tokens = resource_tokens(user_input)
+    if not tokens:
+        return ()
+
+    # Only aliases sharing at least one trigram with the message are scored
+    candidates = {alias for gram in token_trigrams(tokens) for alias in RESOURCE_TRIGRAM_INDEX.get(gram, ())}
+    weights = RESOURCE_TRIGRAM_WEIGHTS
+    windows = {}
+    scores = {}
+    for alias in candidates:
+        alias_tokens, alias_grams, alias_weight = RESOURCE_ALIAS_TRIGRAMS[alias]
+        width = min(len(alias_tokens), len(tokens))
+        # Compare against every run of words as long as the alias, so "apush histroy" still finds "apush"
+        for start in range(len(tokens) - width + 1):
+            if (start, width) not in windows:
+                grams = token_trigrams(tokens[start:start + width])
+                windows[(start, width)] = (grams, sum(weights.get(gram, RESOURCE_UNSEEN_TRIGRAM_WEIGHT) for gram in grams))
+            window, window_weight = windows[(start, width)]
+            # A word lined up against an alias word has to start with the same letter - 'lsat' is not a typo of 'sat'
+            if width == len(alias_tokens) and any(a[0] != b[0] for a, b in zip(tokens[start:start + width], alias_tokens)):
+                continue
+            shared = sum(weights[gram] for gram in window & alias_grams)
+            score = 2 * shared / (window_weight + alias_weight)
+            name = RESOURCE_ALIASES[alias]
+            if score > scores.get(name, 0):
+                scores[name] = score
+
+    best = max(scores.values(), default=0)
+    if best < RESOURCE_FUZZY_THRESHOLD:
+        return ()
+    # Stable sort - equal scores keep the registry's order
+    close = sorted((name for name in RESOURCES if scores.get(name, 0) >= best - RESOURCE_FUZZY_MARGIN), key=scores.get, reverse=True)
+
+    # "ap us" or "ap comp" is the start of several resources' names - ask rather than guess one of them
+    prefixed = {RESOURCE_ALIASES[alias] for alias in candidates if resource_prefix_of(tokens, RESOURCE_ALIAS_TRIGRAMS[alias][0])}
+    if close[0] in prefixed and len(prefixed) > 1:
+        close = sorted((name for name in RESOURCES if name in prefixed), key=lambda name: scores.get(name, 0), reverse=True)
+    return tuple(close[:RESOURCE_FUZZY_SUGGESTIONS])
+
+def check_resource_routes():
+    """Every alias has to route back to its own resource - catches collisions as the catalogue grows"""
+    for name, (aliases, _) in RESOURCES.items():
+        for alias in (name,) + aliases:
+            routed = find_resource(f"!{alias}")
+            if routed != name:
+                raise ValueError(f"Resource alias '{alias}' routes to '{routed}' instead of '{name}'")
+
+check_resource_routes()
+
+def get_response(user_input: str) -> str:
+    lowered: str = user_input.lower()
+
+    resource = find_resource(lowered)
+    if resource:
+        return RESOURCES[resource][1]
+
+    elif lowered == '!help' or lowered == 'help':
+        return HELP_MESSAGE
+
     elif lowered.startswith('!'):
-        return 'i don\'t understand that fr 😭 type `!help` to see what i can do!'
+        # Typos get the static answer instead of the user retrying through the AI
+        matches = fuzzy_find_resource(lowered)
+        if len(matches) == 1:
+            print(f"[DEBUG] Fuzzy matched '{lowered}' to {matches[0]}")
+            return RESOURCES[matches[0]][1]
+        elif matches:
+            suggestions = ' or '.join(f"`!{name}`" for name in matches)
+            return f"i don't understand that fr 😭 did you mean {suggestions}? type `!help` to see what i can do!"
+        return UNKNOWN_COMMAND_MESSAGE
 
     else:
         return None
 
+def get_rate_limit_response(error: AIRateLimited, mode: str) -> str:
+    """What to say when the limiter holds a request back"""
+    wait = f"{int(error.retry_in) + 1}s" if error.retry_in < 90 else f"{int(error.retry_in // 60) + 1} min"
+    if error.reason == "user":
+        if mode == "flirty":
+            return f"babe slow down 😳 give me like {wait} to catch up"
+        return f"slow down bestie 😭 give me like {wait} to catch up"
+    return f"yo heads up! 😭 i'm getting a lot of questions rn, try me again in like {wait}. type `!help` for resources tho! 💕"
+
+async def sync_shared_flags(interval: float = 10):
+    """Pick up an upstream backoff started by another process"""
+    while True:
+        try:
+            blocked_until = await state_backend.get_flag("ai_blocked_until")
+            if blocked_until:
+                remaining = float(blocked_until) - time.time()
+                if remaining > 0 and not ai_limiter.blocked:
+                    print(f"[DEBUG] Another process is backing off the AI for {remaining:.0f}s")
+                    ai_limiter.blocked_until = time.monotonic() + remaining
+        except Exception as e:
+            print(f"[ERROR] Shared flag sync failed: {e}")
+        await asyncio.sleep(interval)
+
+@client.event
+async def setup_hook() -> None:
+    # Open the pooled inference session once, before the gateway connects
+    await inference.start()
+    await sessions.open()
+    if state_backend.shared:
+        sessions.tasks.append(asyncio.create_task(sync_shared_flags()))
+
 @client.event
 async def on_ready() -> None:
     print(f'{client.user} is now running!')
     sys.stdout.flush()  # Force flush
 
+@client.event
+async def on_shard_ready(shard_id: int) -> None:
+    print(f'Shard {shard_id} is ready')
+    sys.stdout.flush()
+
 @client.event
 async def on_message(message: Message) -> None:
-    global ai_limit_reached, ai_limit_notified
 
     print(f"[DEBUG] Message received: '{message.content[:50]}'")
     sys.stdout.flush()
@@ -1064,15 +3214,20 @@ async def on_message(message: Message) -> None:
     lowered_content = message.content.lower()
     user_id = message.author.id
     is_dm = isinstance(message.channel, DMChannel)
+    guild_id = message.guild.id if message.guild else None
     contains_abg_tutor = 'abg tutor' in lowered_content
     is_mentioned = client.user.mentioned_in(message)
 
     print(f"[DEBUG] abg_tutor={contains_abg_tutor}, mentioned={is_mentioned}")
     sys.stdout.flush()
 
+    # Restore this user's saved session (if any) before anything reads it
+    await sessions.ensure_loaded(user_id, is_dm or contains_abg_tutor or is_mentioned or message.content.startswith('!'))
+
     # Welcome new users
-    if user_id not in welcomed_users and (is_dm or contains_abg_tutor or is_mentioned):
-        welcomed_users.add(user_id)
+    session = sessions.get(user_id)
+    if (is_dm or contains_abg_tutor or is_mentioned) and not (session and session.welcomed):
+        sessions.get_or_create(user_id).welcomed = True
         if is_dm:
             await message.channel.send(NEW_USER_WELCOME)
         else:
@@ -1085,52 +3240,55 @@ async def on_message(message: Message) -> None:
     # Mode selection commands
     if lowered_content == '!bestie':
         actual_mode = set_user_mode(user_id, "bestie")
-        conversation_active[user_id] = True
+        sessions.get_or_create(user_id).conversation_active = True
 
-        try:
-            response, _ = await generate_ai_reply(user_id, "user just selected bestie mode", "User selected bestie mode - confirm it's activated and be encouraging")
-            if response:
-                await message.reply(response + CONVERSATION_START_MSG, mention_author=False)
-            else:
+        async with user_turn(user_id):
+            try:
+                response, _ = await generate_ai_reply(user_id, "user just selected bestie mode", "User selected bestie mode - confirm it's activated and be encouraging", cacheable=True, guild_id=guild_id)
+                if response:
+                    await message.reply(response + CONVERSATION_START_MSG, mention_author=False)
+                else:
+                    await message.reply("bestie mode activated! 💕 let\'s study together fr" + CONVERSATION_START_MSG, mention_author=False)
+            except:
                 await message.reply("bestie mode activated! 💕 let\'s study together fr" + CONVERSATION_START_MSG, mention_author=False)
-        except:
-            await message.reply("bestie mode activated! 💕 let\'s study together fr" + CONVERSATION_START_MSG, mention_author=False)
         return
 
     if lowered_content == '!flirty':
         actual_mode = set_user_mode(user_id, "flirty")
-        conversation_active[user_id] = True
+        sessions.get_or_create(user_id).conversation_active = True
 
         if actual_mode == "flirty":
             context = "User selected flirty mode and it ACTIVATED (1% chance hit!) - be excited and flirty"
         else:
             context = "User selected flirty mode but it didn't activate (99% chance) - playfully tell them they'll stay besties for now"
 
-        try:
-            response, _ = await generate_ai_reply(user_id, "user just selected flirty mode", context)
-            if response:
-                await message.reply(response + CONVERSATION_START_MSG, mention_author=False)
-            else:
+        async with user_turn(user_id):
+            try:
+                response, _ = await generate_ai_reply(user_id, "user just selected flirty mode", context, cacheable=True, guild_id=guild_id)
+                if response:
+                    await message.reply(response + CONVERSATION_START_MSG, mention_author=False)
+                else:
+                    if actual_mode == "flirty":
+                        await message.reply("flirty mode activated cutie! 💖 ready to study with me?" + CONVERSATION_START_MSG, mention_author=False)
+                    else:
+                        await message.reply("tried flirty mode but we\'re staying besties for now 😌💕 (10% chance!)" + CONVERSATION_START_MSG, mention_author=False)
+            except:
                 if actual_mode == "flirty":
                     await message.reply("flirty mode activated cutie! 💖 ready to study with me?" + CONVERSATION_START_MSG, mention_author=False)
                 else:
                     await message.reply("tried flirty mode but we\'re staying besties for now 😌💕 (10% chance!)" + CONVERSATION_START_MSG, mention_author=False)
-        except:
-            if actual_mode == "flirty":
-                await message.reply("flirty mode activated cutie! 💖 ready to study with me?" + CONVERSATION_START_MSG, mention_author=False)
-            else:
-                await message.reply("tried flirty mode but we\'re staying besties for now 😌💕 (10% chance!)" + CONVERSATION_START_MSG, mention_author=False)
         return
 
     # Stop teaching command
     if lowered_content == '!stop teaching':
-        if is_teaching_mode(user_id):
-            set_teaching_mode(user_id, False)
-            mode = get_user_mode(user_id)
-            bye_msg = random.choice(GOODBYE_MESSAGES_FLIRTY if mode == "flirty" else GOODBYE_MESSAGES_BESTIE)
-            await message.reply(f"teaching mode ended! {bye_msg}", mention_author=False)
-        else:
-            await message.reply("you're not in teaching mode rn bestie!", mention_author=False)
+        async with user_turn(user_id):
+            if is_teaching_mode(user_id):
+                set_teaching_mode(user_id, False)
+                mode = get_user_mode(user_id)
+                bye_msg = random.choice(GOODBYE_MESSAGES_FLIRTY if mode == "flirty" else GOODBYE_MESSAGES_BESTIE)
+                await message.reply(f"teaching mode ended! {bye_msg}", mention_author=False)
+            else:
+                await message.reply("you're not in teaching mode rn bestie!", mention_author=False)
         return
 
     # Handle resource commands
@@ -1148,12 +3306,13 @@ async def on_message(message: Message) -> None:
             return
 
     # Check if in active conversation
-    in_active_conversation = user_id in conversation_active and conversation_active[user_id]
+    session = sessions.get(user_id)
+    in_active_conversation = session is not None and session.conversation_active
 
     # DMs auto-start conversation
     if is_dm:
         if not in_active_conversation:
-            conversation_active[user_id] = True
+            sessions.get_or_create(user_id).conversation_active = True
             in_active_conversation = True
 
     # Conversation starters
@@ -1162,85 +3321,81 @@ async def on_message(message: Message) -> None:
 
     # Start new conversation
     if is_conversation_starter and not in_active_conversation:
-        conversation_active[user_id] = True
+        sessions.get_or_create(user_id).conversation_active = True
 
-        try:
-            response, _ = await generate_ai_reply(
-                user_id, 
-                "user just started conversation", 
-                "User just started conversation - greet them warmly based on time of day"
-            )
+        async with user_turn(user_id):
+            try:
+                response, _ = await generate_ai_reply(
+                    user_id, 
+                    "user just started conversation", 
+                    "User just started conversation - greet them warmly based on time of day",
+                    cacheable=True,
+                    guild_id=guild_id
+                )
 
-            if response:
-                if is_dm:
-                    await message.channel.send(response + CONVERSATION_START_MSG)
+                if response:
+                    if is_dm:
+                        await message.channel.send(response + CONVERSATION_START_MSG)
+                    else:
+                        await message.reply(response + CONVERSATION_START_MSG, mention_author=False)
                 else:
-                    await message.reply(response + CONVERSATION_START_MSG, mention_author=False)
-            else:
+                    mode = get_user_mode(user_id)
+                    fallback = "hey! what's up?" if mode == "bestie" else "hey cutie! what's up? 💕"
+                    if is_dm:
+                        await message.channel.send(fallback + CONVERSATION_START_MSG)
+                    else:
+                        await message.reply(fallback + CONVERSATION_START_MSG, mention_author=False)
+                return
+
+            except Exception as e:
+                error_str = str(e)
+                print(f"Error starting conversation: {error_str}")
+
+                if isinstance(e, AIRateLimited):
+                    if ai_limiter.should_notify(user_id, e.reason):
+                        await message.reply(get_rate_limit_response(e, get_user_mode(user_id)), mention_author=False)
+                    return
+
                 mode = get_user_mode(user_id)
                 fallback = "hey! what's up?" if mode == "bestie" else "hey cutie! what's up? 💕"
                 if is_dm:
                     await message.channel.send(fallback + CONVERSATION_START_MSG)
                 else:
                     await message.reply(fallback + CONVERSATION_START_MSG, mention_author=False)
-            return
-
-        except Exception as e:
-            error_str = str(e)
-            print(f"Error starting conversation: {error_str}")
-
-            if "RATE_LIMIT" in error_str or "rate limit" in error_str.lower():
-                ai_limit_reached = True
-                if not ai_limit_notified:
-                    ai_limit_notified = True
-                    await message.reply("yo heads up! 😭 we hit the daily ai limit. type `!help` for resources tho! 💕", mention_author=False)
-                    return
-
-            mode = get_user_mode(user_id)
-            fallback = "hey! what's up?" if mode == "bestie" else "hey cutie! what's up? 💕"
-            if is_dm:
-                await message.channel.send(fallback + CONVERSATION_START_MSG)
-            else:
-                await message.reply(fallback + CONVERSATION_START_MSG, mention_author=False)
-            return
+                return
 
     # Handle goodbye
     if lowered_content == '!bye abg' or lowered_content == '!byeabg':
-        if user_id in conversation_active:
-            del conversation_active[user_id]
-        if user_id in user_histories:
-            del user_histories[user_id]
-        if user_id in user_last_tone:
-            del user_last_tone[user_id]
-        if user_id in user_modes:
-            set_teaching_mode(user_id, False)
+        # Waits for a reply in progress, so it can't wipe the history that reply is about to append to
+        async with user_turn(user_id):
+            session = sessions.get(user_id)
+            if session:
+                session.end_conversation()
 
-        mode = get_user_mode(user_id)
-        goodbye_msg = random.choice(GOODBYE_MESSAGES_FLIRTY if mode == "flirty" else GOODBYE_MESSAGES_BESTIE)
+            mode = get_user_mode(user_id)
+            goodbye_msg = random.choice(GOODBYE_MESSAGES_FLIRTY if mode == "flirty" else GOODBYE_MESSAGES_BESTIE)
 
-        await message.reply(goodbye_msg, mention_author=False)
+            await message.reply(goodbye_msg, mention_author=False)
         return
 
     # Continue active conversation
     if in_active_conversation:
         # Check for image attachments FIRST
-        image_description = ""
-        if message.attachments:
-            for attachment in message.attachments:
-                if attachment.content_type and attachment.content_type.startswith('image/'):
-                    print(f"[DEBUG] Processing image from user {user_id}")
-                    
-                    # Get user mode for personalized animation
-                    mode = get_user_mode(user_id)
-                    
-                    # Show animated processing message
-                    async with message.channel.typing():
-                        processing_msg = await show_image_processing_animation(message.channel, mode)
-                        image_description = await process_image(attachment.url)
-                        await processing_msg.delete()
-                    
-                    print(f"[DEBUG] Image processed: {image_description[:100]}")
-                    break
+        progress = ProgressIndicator(message.channel, get_user_mode(user_id)) if get_image_attachments(message) else None
+        try:
+            image_description = await process_message_images(message, user_id, progress)
+        except BaseException:
+            # e.g. typing() refused with Forbidden - don't leave the status message up
+            if progress:
+                await progress.close()
+            raise
+
+        if image_description == OCR_BUSY_MESSAGE:
+            await progress.close()
+            await send_long_message(message, get_ocr_busy_response(get_user_mode(user_id)), is_dm)
+            return
+        if progress:
+            progress.stage('thinking')
 
         # Combine message content with image description
         full_message = message.content
@@ -1257,69 +3412,99 @@ async def on_message(message: Message) -> None:
                 await message.reply(gibberish_response, mention_author=False)
             return
 
-        if not ai_limit_reached:
+        # A burst of messages becomes one prompt turn instead of racing each other on the session history
+        async with user_turn(user_id, message, full_message) as batch:
+            # Empty when an earlier turn took these messages; inactive when the user said bye while they waited
+            session = sessions.get(user_id)
+            if not batch or not (session and session.conversation_active):
+                if progress:
+                    await progress.close()
+                return
+            message = batch[-1][0]
+            full_message = "\n".join(text for _, text in batch)
+
+            streaming_reply = StreamingReply(message, is_dm) if STREAM_REPLIES else None
+            math_images = []
+
             try:
                 print(f"[DEBUG] Generating AI reply for user {user_id}, message: '{full_message[:50]}'")
-                response, teaching_started = await generate_ai_reply(user_id, full_message)
+                response, teaching_started = await generate_ai_reply(
+                    user_id,
+                    full_message,
+                    on_partial=streaming_reply.update if streaming_reply else None,
+                    on_math=math_images.append,
+                    guild_id=guild_id
+                )
+                if progress:
+                    await progress.close()
 
                 if response:
                     print(f"[DEBUG] AI response generated: '{response[:50]}'")
                     if teaching_started:
                         response = response + TEACHING_START_MSG
 
-                    await send_long_message(message, response, is_dm)
+                    if streaming_reply:
+                        await streaming_reply.finish(response)
+                    else:
+                        await send_long_message(message, response, is_dm)
+                    for render_task in math_images:
+                        await send_math_image(message, render_task, is_dm)
                     return
                 else:
                     print(f"[DEBUG] AI returned None response")
 
             except Exception as e:
+                if progress:
+                    await progress.close()
                 error_msg = str(e)
                 print(f"[ERROR] AI Error in conversation: {error_msg}")
 
-                if "rate limit" in error_msg.lower() or "429" in error_msg or "RATE_LIMIT" in error_msg:
-                    ai_limit_reached = True
-                    if not ai_limit_notified:
-                        ai_limit_notified = True
-                        fallback = "yo heads up! 😭 we hit the daily ai limit so responses might be slower. still here to help tho! 💕"
-                        if is_dm:
+                if isinstance(e, AIRateLimited):
+                    if ai_limiter.should_notify(user_id, e.reason):
+                        fallback = get_rate_limit_response(e, get_user_mode(user_id))
+                        if streaming_reply and streaming_reply.sent:
+                            await streaming_reply.finish(fallback)
+                        elif is_dm:
                             await message.channel.send(fallback)
                         else:
                             await message.reply(fallback, mention_author=False)
-                        return
+                    return
 
-        # Fallback when AI fails or limit reached
-        print(f"[DEBUG] Using fallback response for user {user_id}")
-        fallback = "hmm having trouble responding rn 😭 try asking again or type `!help` for resources!"
-        if is_dm:
-            await message.channel.send(fallback)
-        else:
-            await message.reply(fallback, mention_author=False)
-        return
+            # Fallback when AI fails or limit reached
+            if progress:
+                await progress.close()
+            print(f"[DEBUG] Using fallback response for user {user_id}")
+            fallback = "hmm having trouble responding rn 😭 try asking again or type `!help` for resources!"
+            if streaming_reply and streaming_reply.sent:
+                # A partial reply already went out - overwrite it instead of leaving it half-finished
+                await streaming_reply.finish(fallback)
+            elif is_dm:
+                await message.channel.send(fallback)
+            else:
+                await message.reply(fallback, mention_author=False)
+            return
 
     # One-off mentions - Give ONE response without starting conversation
     if (contains_abg_tutor or is_mentioned) and not in_active_conversation:
         user_input = message.content.replace(f'<@{client.user.id}>', '').replace(f'<@!{client.user.id}>', '').strip()
         user_input_cleaned = user_input.lower().replace('abg tutor', '').strip()
 
-        # ADD THIS: Check for image attachments in one-off mentions
         # Check for image attachments in one-off mentions
-        image_description = ""
-        if message.attachments:
-            for attachment in message.attachments:
-                if attachment.content_type and attachment.content_type.startswith('image/'):
-                    print(f"[DEBUG] Processing image in one-off mention from user {user_id}")
-                    
-                    # Get user mode for personalized animation
-                    mode = get_user_mode(user_id)
-                    
-                    # Show animated processing message
-                    async with message.channel.typing():
-                        processing_msg = await show_image_processing_animation(message.channel, mode)
-                        image_description = await process_image(attachment.url)
-                        await processing_msg.delete()  # Remove processing message
-                    
-                    print(f"[DEBUG] Image processed: {image_description[:100]}")
-                    break
+        progress = ProgressIndicator(message.channel, get_user_mode(user_id)) if get_image_attachments(message) else None
+        try:
+            image_description = await process_message_images(message, user_id, progress)
+        except BaseException:
+            # e.g. typing() refused with Forbidden - don't leave the status message up
+            if progress:
+                await progress.close()
+            raise
+
+        if image_description == OCR_BUSY_MESSAGE:
+            await progress.close()
+            await message.reply(get_ocr_busy_response(get_user_mode(user_id)), mention_author=False)
+            return
+        if progress:
+            progress.stage('thinking')
 
         # Combine message content with image description
         if image_description:
@@ -1331,42 +3516,79 @@ async def on_message(message: Message) -> None:
             return
 
         # If there's actual content, give ONE AI response (no conversation mode)
-        if user_input_cleaned and not ai_limit_reached:
-            try:
-                print(f"[DEBUG] One-off mention from user {user_id}: '{user_input_cleaned}'")  # ADD THIS
-                print(f"[DEBUG] Calling AI for one-off response...")  # ADD THIS
-
-                # Generate ONE response without activating conversation mode
-                response, _ = await generate_ai_reply(
-                    user_id, 
-                    user_input_cleaned, 
-                    "This is a ONE-OFF mention, not a conversation. Give a brief, helpful response. Tell them to type `!hi abg` if they want to continue chatting."
-                )
+        if user_input_cleaned:
+            async with user_turn(user_id, message, user_input_cleaned) as batch:
+                if not batch:
+                    if progress:
+                        await progress.close()
+                    return
+                message = batch[-1][0]
+                user_input_cleaned = "\n".join(text for _, text in batch)
+
+                try:
+                    print(f"[DEBUG] One-off mention from user {user_id}: '{user_input_cleaned}'")  # ADD THIS
+                    print(f"[DEBUG] Calling AI for one-off response...")  # ADD THIS
+
+                    # Generate ONE response without activating conversation mode
+                    response, _ = await generate_ai_reply(
+                        user_id, 
+                        user_input_cleaned, 
+                        "This is a ONE-OFF mention, not a conversation. Give a brief, helpful response. Tell them to type `!hi abg` if they want to continue chatting.",
+                        guild_id=guild_id
+                    )
+                    if progress:
+                        await progress.close()
 
-                print(f"[DEBUG] One-off AI response: {response}")  # ADD THIS
+                    print(f"[DEBUG] One-off AI response: {response}")  # ADD THIS
 
-                if response:
-                    # Add guidance to start proper conversation
-                    response += "\n*(wanna keep chatting? type `!hi abg`!)*"
-                    await message.reply(response, mention_author=False)
-                    return
-                else:
-                    print(f"[DEBUG] One-off response was None, using fallback")  # ADD THIS
+                    if response:
+                        # Add guidance to start proper conversation
+                        response += "\n*(wanna keep chatting? type `!hi abg`!)*"
+                        await message.reply(response, mention_author=False)
+                        return
+                    else:
+                        print(f"[DEBUG] One-off response was None, using fallback")  # ADD THIS
 
-            except Exception as e:
-                error_str = str(e)
-                print(f"[ERROR] AI Error for one-off mention: {error_str}")
+                except Exception as e:
+                    if progress:
+                        await progress.close()
+                    error_str = str(e)
+                    print(f"[ERROR] AI Error for one-off mention: {error_str}")
 
-                if "RATE_LIMIT" in error_str or "rate limit" in error_str.lower():
-                    ai_limit_reached = True
+                    if isinstance(e, AIRateLimited):
+                        if ai_limiter.should_notify(user_id, e.reason):
+                            await message.reply(get_rate_limit_response(e, get_user_mode(user_id)), mention_author=False)
+                        return
 
         # Fallback for mentions without content or when AI fails
+        if progress:
+            await progress.close()
         print(f"[DEBUG] Using fallback message for one-off mention")  # ADD THIS
         await message.reply("hey! type `!hi abg` to chat or `!help` for study resources! 💕", mention_author=False)
         return
 
+async def run_bot() -> None:
+    loop = asyncio.get_running_loop()
+    # Render stops us with SIGTERM on every deploy - close cleanly so pending session writes land
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(client.close()))
+
+    try:
+        async with client:
+            await client.start(TOKEN)
+    finally:
+        await sessions.close()
+        await inference.close()
+        await get_http_session().close()
+
 def main() -> None:
-    client.run(token=TOKEN)
+    if os.getenv('RENDER') and STATE_BACKEND == 'sqlite' and not os.path.isabs(STATE_DB_PATH):
+        print(f"[WARNING] STATE_DB_PATH={STATE_DB_PATH} is inside the app directory - sessions will be lost on the next deploy. Point it at a persistent disk")
+    # Start the fork server (and the pools) before any other thread exists
+    ocr_pool.start()
+    math_pool.start()
+    threading.Thread(target=run_server, daemon=True).start()
+    discord.utils.setup_logging()
+    asyncio.run(run_bot())
 
 if __name__ == '__main__':
-    client.run(TOKEN)
+    main()
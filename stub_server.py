@@ -0,0 +1,55 @@
+"""Local stand-in for the chat completions API so the bot can be run without a HF key.
+
+Run `python stub_server.py`, then start the bot with
+HF_INFERENCE_URL=http://127.0.0.1:8765/v1/chat/completions
+"""
+import asyncio
+import json
+import os
+import time
+from aiohttp import web
+
+STUB_PORT = int(os.getenv('STUB_PORT', 8765))
+STUB_DELAY = float(os.getenv('STUB_DELAY', 0.2))  # seconds before the first token
+STUB_TOKEN_DELAY = float(os.getenv('STUB_TOKEN_DELAY', 0.03))  # seconds between streamed tokens
+STUB_STATUS = int(os.getenv('STUB_STATUS', 200))  # e.g. 429 to exercise the rate limiter
+STUB_RETRY_AFTER = os.getenv('STUB_RETRY_AFTER', '30')
+STUB_REPLY = os.getenv('STUB_REPLY', "ok so basically you just take it one step at a time fr")
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    body = await request.json()
+    last = body["messages"][-1]["content"] if body.get("messages") else ""
+    print(f"[DEBUG] Stub got {'stream' if body.get('stream') else 'chat'} request, max_tokens={body.get('max_tokens')}: '{last[:50]}'")
+
+    # Headers can override the env defaults per request
+    status = int(request.headers.get('X-Stub-Status', STUB_STATUS))
+    delay = float(request.headers.get('X-Stub-Delay', STUB_DELAY))
+    if status != 200:
+        return web.Response(status=status, text="rate limit reached", headers={"Retry-After": STUB_RETRY_AFTER})
+
+    await asyncio.sleep(delay)
+    if not body.get("stream"):
+        return web.json_response({
+            "id": f"stub-{time.time_ns()}",
+            "object": "chat.completion",
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": STUB_REPLY}, "finish_reason": "stop"}]
+        })
+
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await resp.prepare(request)
+    for word in STUB_REPLY.split(' '):
+        chunk = {"choices": [{"index": 0, "delta": {"content": word + ' '}}]}
+        await resp.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await asyncio.sleep(STUB_TOKEN_DELAY)
+    await resp.write(b"data: [DONE]\n\n")
+    await resp.write_eof()
+    return resp
+
+def make_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    return app
+
+if __name__ == '__main__':
+    web.run_app(make_app(), host='127.0.0.1', port=STUB_PORT)